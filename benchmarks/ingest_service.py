@@ -0,0 +1,142 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-north-1')
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)  # Before this directory, whose ingest_service.py is this benchmark
+
+from ingest_service import TOPICS, IngestService, subscription_topics
+from payload_codec import encode_readings
+from sensor import create_sensors_from_data_file
+from simulator import topic_for
+
+DATA_FILE = os.path.join(ROOT_DIR, 'data', 'INCA analysis - large domain Datensatz_20250101T0000_20250103T2300.json')
+
+
+class StubDynamoDB:
+    """
+    Stands in for DynamoDB. Every call takes a fixed time, like a network round-trip.
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.item_count = 0
+        self.call_count = 0
+        self.lock = threading.Lock()
+
+    def put_item(self, TableName, Item):
+        time.sleep(self.latency)
+        with self.lock:
+            self.call_count += 1
+            self.item_count += 1
+
+    def update_item(self, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            self.call_count += 1
+
+    def batch_write_item(self, RequestItems):
+        time.sleep(self.latency)
+        with self.lock:
+            self.call_count += 1
+            self.item_count += sum(len(requests) for requests in RequestItems.values())
+        return {'UnprocessedItems': {}}
+
+
+class StubBroker:
+    """
+    Stands in for the MQTT broker. Delivers every published message to the subscriptions of its topic,
+    shared subscriptions ($share/<group>/<topic>) receive the messages of their topic.
+    """
+
+    def __init__(self):
+        self.subscriptions = {}
+        self.unrouted_count = 0  # Messages published to a topic without subscriptions
+
+    def subscribe(self, topic, callback):
+        if topic.startswith('$share/'):
+            topic = topic.split('/', 2)[2]
+        self.subscriptions.setdefault(topic, []).append(callback)
+
+    def publish(self, topic, payload):
+        callbacks = self.subscriptions.get(topic)
+        if not callbacks:
+            self.unrouted_count += 1
+            return
+        for callback in callbacks:
+            callback(topic, payload, False, 1, False)
+
+
+def configure():
+    parser = ArgumentParser(prog='Ingest service benchmark', description='Compares per-message writes with the batched ingest service')
+    parser.add_argument('-r', '--rows', type=int, default=2, help='Number of timestamps to send for every sensor')
+    parser.add_argument('-l', '--latency', type=float, default=0.005, help='Simulated DynamoDB latency per call in seconds')
+    parser.add_argument('-i', '--in-flight', type=int, default=8, help='Batch writes running at the same time')
+    parser.add_argument('-e', '--encoding', type=str, default='json', help='Payload encoding')
+    parser.add_argument('-s', '--shared', action='store_true', help='Subscribe like one of several workers, with shared subscriptions')
+
+    return parser.parse_args()
+
+
+def create_payloads(rows, encoding):
+    timestamps, sensors = create_sensors_from_data_file(DATA_FILE, '')
+    return [
+        encode_readings([sensor.get_data_by_index(timestamp, index)], encoding)
+        for index, timestamp in enumerate(timestamps[:rows])
+        for sensor in sensors
+    ]
+
+
+def run_per_message(service, payloads):
+    """Baseline: every message is normalized and written on its own, like one Lambda invocation per message."""
+    start_time = time.time()
+    for payload in payloads:
+        for item in service.normalize_payload(payload):
+            service.dynamodb.put_item(TableName=service.table_name, Item=item)
+    return time.time() - start_time
+
+
+async def run_service(service, payloads, broker, topic):
+    start_time = time.time()
+    task = asyncio.create_task(service.run())
+    await asyncio.sleep(0)
+
+    # The broker delivers the messages on another thread
+    def publish():
+        for payload in payloads:
+            broker.publish(topic, payload)
+        service.stop()
+
+    threading.Thread(target=publish).start()
+    await task
+    return time.time() - start_time
+
+
+def main():
+    config = configure()
+    payloads = create_payloads(config.rows, config.encoding)
+
+    baseline_db = StubDynamoDB(config.latency)
+    baseline = run_per_message(IngestService(baseline_db), payloads)
+
+    service_db = StubDynamoDB(config.latency)
+    service = IngestService(service_db, max_in_flight=config.in_flight, queue_size=0)
+
+    # Published to the topic of the simulator and delivered to the subscriptions of the service
+    broker = StubBroker()
+    for topic in subscription_topics(TOPICS, 2 if config.shared else 1):
+        broker.subscribe(topic, service.on_message_received)
+    batched = asyncio.run(run_service(service, payloads, broker, topic_for(config.encoding)))
+
+    print(f'{len(payloads)} {config.encoding} messages to {topic_for(config.encoding)}, {config.latency * 1000}ms per DynamoDB call')
+    print(f'Per message: {round(baseline, 2)}s, {baseline_db.call_count} calls ({round(len(payloads) / baseline)} msg/s)')
+    print(f'Service:     {round(batched, 2)}s, {service_db.call_count} calls ({round(len(payloads) / batched)} msg/s), stored {service.stored_count}, {broker.unrouted_count} messages without subscription')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import os
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from lambda_loader import load_lambda
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-north-1')
+os.environ.setdefault('SPILL_QUEUE_URL', 'https://sqs.eu-north-1.amazonaws.com/000000000000/SensordataSpill')
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT_DIR)
+
+from sensor import create_sensors_from_data_file
+
+DATA_FILE = os.path.join(ROOT_DIR, 'data', 'INCA analysis - large domain Datensatz_20250101T0000_20250103T2300.json')
+
+
+class ThrottlingDynamoDB:
+    """
+    Stands in for a DynamoDB table with provisioned capacity. Writes consume one capacity unit
+    per item from a token bucket that refills at the provisioned rate. Batches get the items
+    beyond the capacity back as unprocessed, requests without any capacity are throttled.
+    """
+
+    def __init__(self, table_name, capacity, latency):
+        self.table_name = table_name
+        self.capacity = capacity
+        self.latency = latency
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def take_tokens(self, count):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.capacity)
+        self.last_refill = now
+
+        granted = min(count, int(self.tokens))
+        self.tokens -= granted
+        return granted
+
+    def store(self, items):
+        for item in items:
+            self.items[(item['sensor_id']['S'], item['timestamp']['N'])] = item
+
+    def throttle(self, operation):
+        raise ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': 'Throughput exceeded'}}, operation)
+
+    def put_item(self, TableName, Item):
+        time.sleep(self.latency)
+        if TableName != self.table_name:
+            return
+        with self.lock:
+            if self.take_tokens(1) == 0:
+                self.throttle('PutItem')
+            self.store([Item])
+
+    def update_item(self, **kwargs):
+        # Only used for the field registry, which is not provisioned
+        time.sleep(self.latency)
+
+    def batch_write_item(self, RequestItems):
+        time.sleep(self.latency)
+        unprocessed = {}
+        with self.lock:
+            for table_name, requests in RequestItems.items():
+                # Only the sensor data table is provisioned, the health statistics are written as they come
+                granted = self.take_tokens(len(requests)) if table_name == self.table_name else len(requests)
+                if granted == 0 and table_name == self.table_name:
+                    self.throttle('BatchWriteItem')
+                if table_name == self.table_name:
+                    self.store([request['PutRequest']['Item'] for request in requests[:granted]])
+                if requests[granted:]:
+                    unprocessed[table_name] = requests[granted:]
+        return {'UnprocessedItems': unprocessed}
+
+
+class StubSQS:
+    """
+    Stands in for the spill queue. Received messages stay invisible until they are deleted or returned.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.message_count = 0
+        self.lock = threading.Lock()
+
+    def send_message_batch(self, QueueUrl, Entries):
+        with self.lock:
+            for entry in Entries:
+                self.message_count += 1
+                self.messages.append({'messageId': str(self.message_count), 'body': entry['MessageBody'], 'eventSource': 'aws:sqs'})
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def receive(self, count):
+        with self.lock:
+            batch, self.messages = self.messages[:count], self.messages[count:]
+        return batch
+
+    def return_messages(self, messages):
+        with self.lock:
+            self.messages.extend(messages)
+
+
+def configure():
+    parser = ArgumentParser(prog='Ingest throttling benchmark', description='Sends bursts above the provisioned capacity through the ingest Lambda')
+    parser.add_argument('-c', '--capacity', type=int, default=1000, help='Provisioned write capacity of the table in items per second')
+    parser.add_argument('-b', '--burst-factor', type=float, default=5, help='Offered load as a multiple of the capacity')
+    parser.add_argument('-d', '--duration', type=float, default=3, help='Duration of the burst in seconds')
+    parser.add_argument('-f', '--frame-size', type=int, default=25, help='Readings per IoT message')
+    parser.add_argument('-w', '--concurrency', type=int, default=16, help='Invocations running at the same time')
+    parser.add_argument('-l', '--latency', type=float, default=0.005, help='Simulated DynamoDB latency per call in seconds')
+
+    return parser.parse_args()
+
+
+def create_events(count, frame_size):
+    timestamps, sensors = create_sensors_from_data_file(DATA_FILE, '')
+    readings = []
+    for index, timestamp in enumerate(timestamps):
+        readings.extend(sensor.get_data_by_index(timestamp, index) for sensor in sensors)
+        if len(readings) >= count:
+            break
+
+    readings = readings[:count]
+    return [{'readings': readings[i:i + frame_size]} for i in range(0, len(readings), frame_size)]
+
+
+def run_burst(ingest, events, rate, concurrency):
+    """Invokes the handler with the events at a fixed rate, whether earlier invocations have finished or not."""
+    failed = []
+    start_time = time.monotonic()
+
+    def invoke(event):
+        try:
+            ingest.lambda_handler(event, None)
+        except Exception as e:
+            failed.append((event, e))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for index, event in enumerate(events):
+            time.sleep(max(start_time + index / rate - time.monotonic(), 0))
+            executor.submit(invoke, event)
+
+    return time.monotonic() - start_time, failed
+
+
+def drain(ingest, sqs, batch_size= 10):
+    """Feeds the spill queue back to the handler like an SQS event source mapping, until it is empty."""
+    start_time = time.monotonic()
+    while True:
+        batch = sqs.receive(batch_size)
+        if not batch:
+            return time.monotonic() - start_time
+
+        response = ingest.lambda_handler({'Records': batch}, None)
+        failed_ids = {failure['itemIdentifier'] for failure in response['batchItemFailures']}
+        sqs.return_messages([message for message in batch if message['messageId'] in failed_ids])
+        if failed_ids:
+            time.sleep(0.1)  # Stands in for the visibility timeout
+
+
+def main():
+    config = configure()
+
+    ingest = load_lambda('ingest')
+    controller_module = sys.modules['write_controller']
+    health_module = sys.modules['sensor_health']
+
+    rate = config.capacity * config.burst_factor
+    events = create_events(int(rate * config.duration), config.frame_size)
+    expected = {
+        (item['sensor_id']['S'], item['timestamp']['N'])
+        for event in events
+        for item in map(ingest.normalize_sensor_data, event['readings'])
+        if not health_module.is_sentinel_reading({name: float(value['N']) for name, value in item['measurements']['M'].items()})
+    }
+
+    dynamodb = ThrottlingDynamoDB(ingest.TABLE_NAME, config.capacity, config.latency)
+    sqs = StubSQS()
+    ingest.write_controller = controller_module.WriteController(dynamodb, ingest.TABLE_NAME, sqs)
+    ingest.health_tracker.dynamodb = dynamodb
+    ingest.field_registry.dynamodb = dynamodb
+
+    burst_time, failed = run_burst(ingest, events, rate / config.frame_size, config.concurrency)
+    metrics = ingest.write_controller.metrics()
+    drain_time = drain(ingest, sqs)
+
+    lost = expected - dynamodb.items.keys()
+    print(f'{len(expected)} readings in {len(events)} messages at {round(rate)} readings/s, capacity {config.capacity} items/s')
+    print(f'Burst: {round(burst_time, 2)}s, {metrics["written"]} written, {metrics["spilled"]} spilled, {len(failed)} failed invocations')
+    print(f'State after burst: {metrics}')
+    print(f'Drain: {round(drain_time, 2)}s, state {ingest.write_controller.state}')
+    print(f'Stored {len(expected & dynamodb.items.keys())} of {len(expected)} readings, lost {len(lost)}')
+
+
+if __name__ == '__main__':
+    main()
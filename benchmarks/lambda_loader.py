@@ -0,0 +1,22 @@
+import importlib.util
+import os
+import sys
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda')
+
+
+def load_lambda(name):
+    """
+    Imports the lambda_function.py of the given Lambda directory as a module named after it.
+    Every Lambda uses the same file name, so they cannot be imported as regular modules.
+    """
+    path = os.path.join(LAMBDA_DIR, name, 'lambda_function.py')
+    spec = importlib.util.spec_from_file_location(f'{name}_lambda', path)
+    module = importlib.util.module_from_spec(spec)
+
+    # Modules next to the function and the common layer are importable inside the Lambda, so make them importable here too
+    for directory in (os.path.join(LAMBDA_DIR, 'common'), os.path.dirname(path)):
+        if directory not in sys.path:
+            sys.path.insert(0, directory)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,75 @@
+import base64
+import json
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+from lambda_loader import load_lambda
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-north-1')
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT_DIR)
+
+from sensor import create_sensors_from_data_file
+
+DATA_FILE = os.path.join(ROOT_DIR, 'data', 'INCA analysis - large domain Datensatz_20250101T0000_20250103T2300.json')
+
+
+def configure():
+    parser = ArgumentParser(prog='Payload format benchmark', description='Compares the size and ingest cost of the MQTT payload formats')
+    parser.add_argument('-r', '--rows', type=int, default=4, help='Number of timestamps to encode for every sensor')
+    parser.add_argument('-f', '--frame-sizes', type=int, nargs='+', default=[1, 25], help='Readings per MQTT message')
+
+    return parser.parse_args()
+
+
+def main():
+    config = configure()
+
+    ingest = load_lambda('ingest')
+    codec = sys.modules['payload_codec']
+
+    timestamps, sensors = create_sensors_from_data_file(DATA_FILE, '')
+    readings = [
+        sensor.get_data_by_index(timestamp, index)
+        for index, timestamp in enumerate(timestamps[:config.rows])
+        for sensor in sensors
+    ]
+
+    print(f'{len(readings)} readings from {len(sensors)} sensors')
+    print(f'{"encoding":>10} {"frame":>6} {"bytes/reading":>14} {"msgs/reading":>13} {"ingest us/reading":>18}')
+
+    for encoding in codec.ENCODINGS:
+        for frame_size in config.frame_sizes:
+            try:
+                messages = [
+                    codec.encode_readings(readings[i:i + frame_size], encoding)
+                    for i in range(0, len(readings), frame_size)
+                ]
+            except ValueError as e:
+                print(f'{encoding:>10} {frame_size:>6} skipped: {e}')
+                continue
+
+            # Binary payloads reach the Lambda base64 encoded, JSON payloads already parsed by the IoT rule
+            if encoding == 'json':
+                events = [json.loads(message) for message in messages]
+            else:
+                events = [{'payload': base64.b64encode(message).decode()} for message in messages]
+
+            start_time = time.process_time()
+            for event in events:
+                for reading in ingest.decode_event(event):
+                    ingest.normalize_sensor_data(reading)
+            cpu_time = time.process_time() - start_time
+
+            total_bytes = sum(len(message) for message in messages)
+            print(
+                f'{encoding:>10} {frame_size:>6} {total_bytes / len(readings):>14.1f} '
+                f'{len(messages) / len(readings):>13.3f} {1e6 * cpu_time / len(readings):>18.1f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import json
+import os
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from lambda_loader import load_lambda
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-north-1')
+
+
+class StubTelegramHandler(BaseHTTPRequestHandler):
+    """
+    Answers every Telegram API call with a successful response. Every n-th request
+    is rate limited with a 429, like the real API does under load.
+    """
+    protocol_version = 'HTTP/1.1'  # Allows keep-alive connections
+    disable_nagle_algorithm = True  # Headers and body are written separately, which stalls kept-alive connections otherwise
+    request_count = 0
+    rate_limit_every = 0
+    latency = 0.0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        with StubTelegramHandler.lock:
+            StubTelegramHandler.request_count += 1
+            count = StubTelegramHandler.request_count
+
+        time.sleep(self.latency)
+
+        if self.rate_limit_every and count % self.rate_limit_every == 0:
+            self.respond(429, {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 0}})
+        else:
+            self.respond(200, {'ok': True, 'result': {}})
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def configure():
+    parser = ArgumentParser(prog='Telegram delivery benchmark', description='Sends messages to a local Telegram stub server')
+    parser.add_argument('-n', '--messages', type=int, default=200, help='Number of messages to send')
+    parser.add_argument('-c', '--chats', type=int, default=4, help='Number of chats every message is sent to')
+    parser.add_argument('-l', '--latency', type=float, default=0.005, help='Simulated server latency in seconds')
+    parser.add_argument('-r', '--rate-limit-every', type=int, default=50, help='Answer every n-th request with 429 (0 disables)')
+    parser.add_argument('-d', '--digest-lines', type=int, default=1000, help='Lines of the alert digest sent in one message')
+
+    return parser.parse_args()
+
+
+def run_unpooled(url, chat_ids, count):
+    """Baseline: a new connection for every request and chats served in sequence. Rate limited requests are retried."""
+    start_time = time.time()
+    for i in range(count):
+        for chat_id in chat_ids:
+            while requests.post(f'{url}/sendMessage', json={'chat_id': chat_id, 'text': f'Message {i}'}).status_code == 429:
+                pass
+    return time.time() - start_time
+
+
+def split_legacy(message, max_length= 3500):
+    """Baseline: the former chunking into 3500 character chunks, broken at the last newline of each."""
+    chunks = []
+    start = 0
+    while start < len(message):
+        end = min(start + max_length, len(message))
+        if end < len(message):
+            newline_index = message.rfind("\n", start, end)
+            if newline_index > start:
+                end = newline_index
+        chunks.append(message[start:end])
+        start = end
+    return chunks
+
+
+def create_digest(lines):
+    return "\n\n".join(
+        f"Sensor (Lat 48.{i:04d}, Lon 16.{i:04d}): Weather station reports low temperature (-{i % 9}.5°C). Frost protection recommended."
+        for i in range(lines)
+    )
+
+
+def run_digest(telegram, message, chunks= None):
+    """Sends a digest to all chats, as pre-split chunks or through the delivery of the function. Returns the time and the requests."""
+    start_count = StubTelegramHandler.request_count
+    start_time = time.time()
+    if chunks is not None:
+        telegram.send_to_all_chats(telegram.send_telegram_message_to_chat, chunks)
+    else:
+        telegram.send_telegram_message(message)
+    return time.time() - start_time, StubTelegramHandler.request_count - start_count
+
+
+def run_pooled(telegram, count):
+    start_time = time.time()
+    for i in range(count):
+        telegram.send_telegram_message(f'Message {i}')
+    return time.time() - start_time
+
+
+def main():
+    config = configure()
+
+    StubTelegramHandler.latency = config.latency
+    StubTelegramHandler.rate_limit_every = config.rate_limit_every
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubTelegramHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/botTOKEN'
+
+    telegram = load_lambda('telegram_communication')
+    telegram.TELEGRAM_API_URL = url
+    telegram.TELEGRAM_CHAT_IDS = [str(-1000 - i) for i in range(config.chats)]
+
+    sends = config.messages * config.chats
+
+    # Both runs see the same share of 429s, which the stub answers with retry_after 0
+    unpooled = run_unpooled(url, telegram.TELEGRAM_CHAT_IDS, config.messages)
+    pooled = run_pooled(telegram, config.messages)
+
+    digest = create_digest(config.digest_lines)
+    digest_runs = [
+        ('3500 char chunks', run_digest(telegram, digest, split_legacy(digest))),
+        ('Packed messages', run_digest(telegram, digest, telegram.pack_lines(digest))),
+        ('Document', run_digest(telegram, digest)),
+    ]
+
+    server.shutdown()
+
+    print(f'Sent {sends} messages to {config.chats} chats')
+    print(f'Unpooled, sequential: {round(unpooled, 2)}s ({round(sends / unpooled)} msg/s)')
+    print(f'Pooled, parallel:     {round(pooled, 2)}s ({round(sends / pooled)} msg/s)')
+
+    print(f'Digest of {config.digest_lines} lines ({len(digest)} characters) to {config.chats} chats')
+    for name, (duration, request_count) in digest_runs:
+        print(f'{name + ":":<22}{round(duration, 2)}s, {request_count} requests')
+
+
+if __name__ == '__main__':
+    main()
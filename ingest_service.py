@@ -0,0 +1,277 @@
+import asyncio
+import os
+import signal
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process
+
+import boto3
+from botocore.config import Config
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(ROOT_DIR, 'lambda', 'common'))
+sys.path.append(os.path.join(ROOT_DIR, 'lambda', 'ingest'))
+
+import iot_core as ic
+from payload_codec import decode_readings
+from lambda_function import normalize_sensor_data
+from partitioning import FieldRegistry
+from sensor_health import SensorHealthTracker
+
+# MQTT Broker Configuration
+BROKER = "a86hzqaw9f6v0-ats.iot.eu-north-1.amazonaws.com"
+PORT = 8883
+TOPIC = "sdk/test/python"
+BINARY_TOPIC = "sdk/test/binary"  # The simulator publishes msgpack and cbor messages to their own topic
+TOPICS = [TOPIC, BINARY_TOPIC]
+SHARED_SUBSCRIPTION_GROUP = "ingest"  # Workers share the topic, each message is delivered to one of them
+ROOT_CERT_FILE = "./AmazonRootCA1.pem"
+CERT_FILE = "./certs/IngestService.cert.pem"
+KEY_FILE = "./certs/IngestService.private.key"
+CLIENT_ID = "ingestService"
+
+# DynamoDB Configuration
+TABLE_NAME = "Sensordata"
+MAX_BATCH_WRITE_ITEMS = 25  # Limit of DynamoDB BatchWriteItem
+MAX_BATCH_WRITE_RETRIES = 8
+ENQUEUE_TIMEOUT_SECONDS = 5  # The MQTT thread waits this long for room in a full queue before a message is dropped
+
+SHUTDOWN = object()  # Queued to stop the service after all pending readings are written
+
+
+class IngestService:
+    """
+    Consumes MQTT payloads from an asyncio queue, normalizes their readings and writes them
+    to DynamoDB in batches. Several batches are written at the same time.
+    """
+
+    def __init__(self, dynamodb, table_name= TABLE_NAME, max_in_flight= 8, flush_interval= 0.2, queue_size= 10000):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.max_in_flight = max_in_flight
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+
+        # Created by run(), inside the loop that consumes it
+        self.queue = None
+        self.loop = None
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+        self.health_tracker = SensorHealthTracker(dynamodb)
+        self.health_flush = None  # Flush of the sensor health running in the background, at most one at a time
+        self.field_registry = FieldRegistry(dynamodb)
+
+        self.received_count = 0
+        self.stored_count = 0
+        self.failed_count = 0
+        self.dropped_count = 0  # Messages that found the queue full
+        self.count_lock = threading.Lock()  # Batches are written from the executor threads
+
+    def on_message_received(self, topic, payload, dup, qos, retain, **kwargs):
+        """
+        Called on the MQTT event-loop thread, hands the payload over to the asyncio loop. While the queue
+        is full the MQTT thread waits, which holds back further messages from the broker. Messages that
+        find no room within ENQUEUE_TIMEOUT_SECONDS are dropped and counted.
+        """
+        future = asyncio.run_coroutine_threadsafe(self.queue.put(payload), self.loop)
+        try:
+            future.result(timeout=ENQUEUE_TIMEOUT_SECONDS)
+        except Exception as e:
+            future.cancel()
+            with self.count_lock:
+                self.dropped_count += 1
+            print(f"Dropping message, the queue is full: {e!r}")
+
+    def stop(self):
+        # Also called by the signal handlers on the loop thread, so it must not wait for room in the queue
+        asyncio.run_coroutine_threadsafe(self.queue.put(SHUTDOWN), self.loop)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        slots = asyncio.Semaphore(self.max_in_flight)
+        in_flight = set()
+        pending = []
+        last_flush = time.monotonic()
+
+        while True:
+            try:
+                payload = await asyncio.wait_for(self.queue.get(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                payload = None
+
+            if payload is SHUTDOWN:
+                break
+
+            if payload is not None:
+                pending.extend(self.normalize_payload(payload))
+
+            # The health statistics are flushed in the background, the consumer does not wait for the write
+            health_flush_due = time.monotonic() - self.health_tracker.last_flush >= self.health_tracker.flush_interval
+            if health_flush_due and (self.health_flush is None or self.health_flush.done()):
+                self.health_flush = self.loop.run_in_executor(self.executor, self.flush_health)
+
+            # Write full batches right away, partial ones once the flush interval has passed
+            now = time.monotonic()
+            while len(pending) >= MAX_BATCH_WRITE_ITEMS or (pending and now - last_flush >= self.flush_interval):
+                batch, pending = pending[:MAX_BATCH_WRITE_ITEMS], pending[MAX_BATCH_WRITE_ITEMS:]
+                await slots.acquire()
+                task = self.loop.run_in_executor(self.executor, self.write_batch, batch)
+                task.add_done_callback(lambda _: slots.release())
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+                last_flush = now
+
+        # Write what is left before shutting down
+        for start in range(0, len(pending), MAX_BATCH_WRITE_ITEMS):
+            in_flight.add(self.loop.run_in_executor(self.executor, self.write_batch, pending[start:start + MAX_BATCH_WRITE_ITEMS]))
+
+        if in_flight:
+            await asyncio.gather(*in_flight, return_exceptions=True)
+
+        if self.health_flush is not None:
+            await self.health_flush
+        self.flush_health()
+
+        self.executor.shutdown()
+
+    def normalize_payload(self, payload):
+        try:
+            readings = decode_readings(payload)
+            self.received_count += len(readings)
+            items = [normalize_sensor_data(reading) for reading in readings]
+
+            # Readings without data only count towards the sensor health, they are not stored
+            return [item for item in items if self.health_tracker.record(item)]
+        except Exception as e:
+            print(f"Dropping bad payload: {e}")
+            with self.count_lock:
+                self.failed_count += 1
+            return []
+
+    def flush_health(self):
+        try:
+            self.health_tracker.flush()
+        except Exception as e:
+            print(f"Could not flush sensor health: {e}")
+
+    def write_batch(self, items):
+        """
+        Writes up to 25 items with BatchWriteItem. Retries unprocessed items and failed requests,
+        e.g. an expired token or a network error, with exponential back-off. Never raises, items
+        that could not be written are counted as failed.
+        """
+        requests = [{'PutRequest': {'Item': item}} for item in items]
+        error = None
+
+        for attempt in range(MAX_BATCH_WRITE_RETRIES):
+            try:
+                response = self.dynamodb.batch_write_item(RequestItems={self.table_name: requests})
+                requests = response.get('UnprocessedItems', {}).get(self.table_name, [])
+                error = None
+            except Exception as e:
+                error = e
+            if not requests:
+                break
+            time.sleep(min(0.05 * 2 ** attempt, 2))
+
+        with self.count_lock:
+            self.stored_count += len(items) - len(requests)
+            self.failed_count += len(requests)
+        if requests:
+            print(f"Could not write {len(requests)} items after {MAX_BATCH_WRITE_RETRIES} attempts" + (f": {error}" if error else ""))
+
+        try:
+            self.field_registry.register_items(items)
+        except Exception as e:
+            print(f"Could not register fields: {e}")
+
+
+def create_dynamodb_client(endpoint_url= None, max_in_flight= 8):
+    return boto3.client(
+        'dynamodb',
+        endpoint_url=endpoint_url,
+        config=Config(max_pool_connections=max_in_flight, retries={'mode': 'adaptive'}, tcp_keepalive=True))
+
+
+def configure():
+    parser = ArgumentParser(prog='Ingest Service', description='Subscribes to the sensor topic and writes the readings to DynamoDB')
+    parser.add_argument('-w', '--workers', type=int, default=1, help= 'Number of worker processes. Workers share the topic subscription')
+    parser.add_argument('-i', '--in-flight', type=int, default=8, help= 'Number of batch writes running at the same time per worker')
+    parser.add_argument('-f', '--flush-interval', type=float, default=0.2, help= 'Seconds after which a partial batch is written')
+    parser.add_argument('-l', '--local-broker', type=str, default=None, help= 'host:port of a local MQTT broker without TLS')
+    parser.add_argument('-d', '--dynamodb-endpoint', type=str, default=None, help= 'Endpoint URL of a local DynamoDB stand-in')
+    parser.add_argument('-t', '--table', type=str, default=TABLE_NAME, help= 'DynamoDB table name')
+    parser.add_argument('--topic', type=str, action='append', default=None, help= f'Topic to subscribe to, can be repeated. Defaults to {TOPIC} and {BINARY_TOPIC}, the topics of the simulator')
+
+    return parser.parse_args()
+
+
+def subscription_topics(topics, workers):
+    """Returns the topic filters to subscribe to. Several workers share each topic, so every message is delivered to one of them."""
+    if workers > 1:
+        return [f"$share/{SHARED_SUBSCRIPTION_GROUP}/{topic}" for topic in topics]
+    return list(topics)
+
+
+def run_worker(config, worker_id):
+    service = IngestService(
+        create_dynamodb_client(config.dynamodb_endpoint, config.in_flight),
+        config.table,
+        config.in_flight,
+        config.flush_interval)
+
+    async def start():
+        task = asyncio.create_task(service.run())
+        await asyncio.sleep(0)  # Let the service pick up the running loop before messages arrive
+
+        client_id = f"{CLIENT_ID}-{worker_id}"
+        if config.local_broker:
+            host, port = config.local_broker.split(':')
+            ic.connect_to_local_broker(host, int(port), client_id)
+        else:
+            ic.connect_to_iot_core(BROKER, PORT, ROOT_CERT_FILE, CERT_FILE, KEY_FILE, client_id)
+
+        for topic in subscription_topics(config.topic or TOPICS, config.workers):
+            ic.subscribe_to_iot_core(topic, service.on_message_received)
+
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, service.stop)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGINT, service.stop)
+        await task
+
+    start_time = time.time()
+    asyncio.run(start())
+    ic.disconnect_from_iot_core()
+
+    runtime = time.time() - start_time
+    print(
+        f"Worker {worker_id}: stored {service.stored_count} of {service.received_count} readings in {round(runtime, 2)}s, "
+        f"{service.failed_count} failed, {service.dropped_count} messages dropped"
+    )
+
+
+def main():
+    config = configure()
+
+    if config.workers == 1:
+        run_worker(config, 0)
+        return
+
+    workers = [Process(target=run_worker, args=(config, i)) for i in range(config.workers)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # The workers received the signal as well and flush their pending readings
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == "__main__":
+    main()
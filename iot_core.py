@@ -4,7 +4,6 @@ import sys
 import json
 
 
-
 # Callback when connection is accidentally lost.
 def on_connection_interrupted(connection, error, **kwargs):
     print("Connection interrupted. error: {}".format(error))
@@ -81,6 +80,41 @@ def connect_to_iot_core(broker, port, root_cert_file, cert_file, key_file, clien
     print("Connected!")
 
 
+def connect_to_local_broker(broker, port, client_id):
+    global mqtt_connection
+
+    # Plain TCP connection without TLS, e.g. to a local Mosquitto broker for benchmarks
+    mqtt_connection = mqtt.Connection(
+        client=mqtt.Client(),
+        host_name=broker,
+        port=port,
+        client_id=client_id,
+        clean_session=True,
+        keep_alive_secs=30,
+        on_connection_interrupted=on_connection_interrupted,
+        on_connection_resumed=on_connection_resumed,
+        on_connection_success=on_connection_success,
+        on_connection_failure=on_connection_failure,
+        on_connection_closed=on_connection_closed)
+
+    print(f"Connecting to local broker {broker}:{port} with client ID '{client_id}'...")
+    mqtt_connection.connect().result()
+    print("Connected!")
+
+
+def subscribe_to_iot_core( topic, callback= on_message_received ):
+    global mqtt_connection
+
+    print(f"Subscribing to topic '{topic}'...")
+    subscribe_future, _ = mqtt_connection.subscribe(
+        topic=topic,
+        qos=mqtt.QoS.AT_LEAST_ONCE,
+        callback=callback)
+
+    subscribe_result = subscribe_future.result()
+    print("Subscribed with {}".format(str(subscribe_result['qos'])))
+
+
 def publish_to_iot_core( topic, payload ):
     global mqtt_connection
 
@@ -90,6 +124,14 @@ def publish_to_iot_core( topic, payload ):
         payload=message_json,
         qos=mqtt.QoS.AT_LEAST_ONCE)
 
+def publish_payload_to_iot_core( topic, payload ):
+    global mqtt_connection
+
+    mqtt_connection.publish(
+        topic=topic,
+        payload=payload,
+        qos=mqtt.QoS.AT_LEAST_ONCE)
+
 def disconnect_from_iot_core():
     global mqtt_connection
 
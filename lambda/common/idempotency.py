@@ -0,0 +1,125 @@
+import logging
+import time
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+from runtime import client, env
+
+# Config
+dynamodb = client('dynamodb')
+
+EVENT_IDEMPOTENCY_TABLE = env('EVENT_IDEMPOTENCY_TABLE', 'EventIdempotencyTable')
+EVENT_TTL_SECONDS = env('EVENT_TTL_SECONDS', 7 * 24 * 60 * 60, int)  # Completed events are removed by DynamoDB TTL after this time
+EVENT_LEASE_SECONDS = env('EVENT_LEASE_SECONDS', 900, int)  # Lease of a claim without a Lambda context, the maximum Lambda timeout
+LEASE_MARGIN_SECONDS = 5  # Added to the remaining time of the invocation, so a claim never expires while it runs
+EVENT_CACHE_SIZE = env('EVENT_CACHE_SIZE', 1024, int)  # Recently completed events remembered by a warm container
+
+STATUS_IN_PROGRESS = 'IN_PROGRESS'
+STATUS_COMPLETED = 'COMPLETED'
+
+logger = logging.getLogger()
+
+# Keys of events this container has seen completed, oldest first
+recent_events = OrderedDict()
+
+
+def remember_event(pk, sk):
+    """
+    Adds the event to the in-memory cache of recently completed events.
+    """
+    recent_events[(pk, sk)] = True
+    recent_events.move_to_end((pk, sk))
+    if len(recent_events) > EVENT_CACHE_SIZE:
+        recent_events.popitem(last=False)
+
+
+def lease_seconds(context):
+    """
+    Returns how long a claim is held: until the invocation times out, or EVENT_LEASE_SECONDS without a context.
+    """
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        return int(context.get_remaining_time_in_millis() / 1000) + LEASE_MARGIN_SECONDS
+    return EVENT_LEASE_SECONDS
+
+
+def claim_event(pk, sk, context=None):
+    """
+    Claims the event with the given primary and sort key for processing.
+    Returns False if the event was completed or is being processed by another invocation.
+    The claim is a single conditional write, so concurrent duplicates cannot both succeed. It is
+    held IN_PROGRESS until the invocation would time out, so a retry can take over the claim of an
+    invocation that timed out or crashed. Call complete_event once the event is processed.
+    """
+    if (pk, sk) in recent_events:
+        recent_events.move_to_end((pk, sk))
+        logger.debug(f"Event {pk}/{sk} found in the idempotency cache.")
+        return False
+
+    now = int(time.time())
+    try:
+        dynamodb.put_item(
+            TableName=EVENT_IDEMPOTENCY_TABLE,
+            Item={
+                'pk': {'S': pk},
+                'sk': {'S': sk},
+                'status': {'S': STATUS_IN_PROGRESS},
+                'expires_at': {'N': str(now + lease_seconds(context))}
+            },
+            ConditionExpression='attribute_not_exists(pk) OR (#status = :in_progress AND expires_at < :now)',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={
+                ':in_progress': {'S': STATUS_IN_PROGRESS},
+                ':now': {'N': str(now)}
+            },
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        # Claims written before the status was introduced count as completed
+        old_status = e.response.get('Item', {}).get('status', {}).get('S', STATUS_COMPLETED)
+        if old_status == STATUS_COMPLETED:
+            remember_event(pk, sk)
+        return False
+
+    return True
+
+
+def complete_event(pk, sk):
+    """
+    Marks a claimed event as processed. It is skipped by every later claim until EVENT_TTL_SECONDS have passed.
+    """
+    dynamodb.update_item(
+        TableName=EVENT_IDEMPOTENCY_TABLE,
+        Key={
+            'pk': {'S': pk},
+            'sk': {'S': sk}
+        },
+        UpdateExpression='SET #status = :completed, expires_at = :expires_at',
+        ExpressionAttributeNames={'#status': 'status'},
+        ExpressionAttributeValues={
+            ':completed': {'S': STATUS_COMPLETED},
+            ':expires_at': {'N': str(int(time.time()) + EVENT_TTL_SECONDS)}
+        }
+    )
+    remember_event(pk, sk)
+
+
+def release_event(pk, sk):
+    """
+    Removes the claim of an event whose processing failed, so a retry can process it again.
+    Called while handling the error of the processing, so its own errors are only logged:
+    a claim that cannot be removed expires with its lease.
+    """
+    recent_events.pop((pk, sk), None)
+    try:
+        dynamodb.delete_item(
+            TableName=EVENT_IDEMPOTENCY_TABLE,
+            Key={
+                'pk': {'S': pk},
+                'sk': {'S': sk}
+            }
+        )
+    except Exception as e:
+        logger.error(f"Failed to release the claim of event {pk}/{sk}: {str(e)}")
@@ -0,0 +1,38 @@
+import json
+import logging
+
+from runtime import client, env
+
+# Config
+TELEGRAM_LAMBDA_ARN = env('TELEGRAM_LAMBDA_ARN', 'arn:aws:lambda:eu-north-1:881490115333:function:Telegram_Communication')
+NOTIFICATION_QUEUE_URL = env('NOTIFICATION_QUEUE_URL')  # SQS queue in front of the Telegram Lambda, falls back to async invokes if not set
+
+logger = logging.getLogger()
+
+
+def enqueue_notification(action, payload, dedup_key, group_id):
+    """
+    Hands a notification to the Telegram Lambda without waiting for its delivery.
+    Uses the notification queue if configured, otherwise an asynchronous invoke.
+    The group ID orders the messages of a FIFO queue, usually the name of the calling function.
+    """
+    notification = {"action": action, "dedup_key": dedup_key, **payload}
+
+    if NOTIFICATION_QUEUE_URL:
+        params = {}
+        if NOTIFICATION_QUEUE_URL.endswith('.fifo'):
+            params = {"MessageGroupId": group_id, "MessageDeduplicationId": dedup_key}
+
+        response = client('sqs').send_message(
+            QueueUrl=NOTIFICATION_QUEUE_URL,
+            MessageBody=json.dumps(notification),
+            **params
+        )
+        logger.debug(f"Notification enqueued with action: {action}, message ID: {response['MessageId']}")
+    else:
+        response = client('lambda').invoke(
+            FunctionName=TELEGRAM_LAMBDA_ARN,
+            InvocationType='Event',
+            Payload=json.dumps({**notification, "async": True})
+        )
+        logger.debug(f"Telegram Lambda invoked asynchronously with action: {action}, status: {response['StatusCode']}")
@@ -0,0 +1,133 @@
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from runtime import CLIENT_CONFIG, env
+
+# Config
+FIELD_REGISTRY_TABLE = env('FIELD_REGISTRY_TABLE', 'SensorFields')  # One item per field, lists the partitions
+FIELD_INDEX_NAME = env('FIELD_INDEX_NAME', 'field_id-timestamp-index')  # GSI of the sensor data table
+FIELD_SIZE_DEGREES = env('FIELD_SIZE_DEGREES', 0.1, float)  # Edge length of the fields of sensors without a registered field
+# Fields needed to fan out to workers, 0 always processes in-process. Below it, the invocations and cold starts
+# of the workers cost more than the queries they run in parallel
+FAN_OUT_MIN_FIELDS = env('FAN_OUT_MIN_FIELDS', 10, int)
+MAX_PARALLEL_WORKERS = env('MAX_PARALLEL_WORKERS', 50, int)
+WORKER_TIMEOUT_SECONDS = env('WORKER_TIMEOUT_SECONDS', 300, int)  # Should match the timeout of the function
+
+# Worker invocations wait for the result. They are not retried by the SDK, so a slow worker is not started twice
+worker_client = None
+
+
+def field_of(latitude, longitude):
+    """
+    Returns the ID of the field a location belongs to: the cell of a grid with FIELD_SIZE_DEGREES sides.
+    """
+    return f"field_{math.floor(float(latitude) / FIELD_SIZE_DEGREES)}_{math.floor(float(longitude) / FIELD_SIZE_DEGREES)}"
+
+
+class FieldRegistry:
+    """
+    Records the fields sensor data was written for and the sensors of every field, so coordinators
+    and workers can list them without scanning the sensor data. Every sensor is only added to its
+    field once per container.
+    """
+
+    def __init__(self, dynamodb, table_name= FIELD_REGISTRY_TABLE):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.known_sensors = set()  # (field_id, sensor_id) pairs
+
+    def register_items(self, items):
+        new_sensors = {}
+        for item in items:
+            key = (item['field_id']['S'], item['sensor_id']['S'])
+            if key not in self.known_sensors:
+                new_sensors.setdefault(key[0], set()).add(key[1])
+
+        for field_id, sensor_ids in new_sensors.items():
+            # Marked before writing, so concurrent batches do not write the same sensors again
+            keys = {(field_id, sensor_id) for sensor_id in sensor_ids}
+            self.known_sensors.update(keys)
+            try:
+                self.dynamodb.update_item(
+                    TableName=self.table_name,
+                    Key={'field_id': {'S': field_id}},
+                    UpdateExpression='ADD sensor_ids :sensor_ids',
+                    ExpressionAttributeValues={':sensor_ids': {'SS': sorted(sensor_ids)}}
+                )
+            except Exception:
+                self.known_sensors.difference_update(keys)
+                raise
+
+
+def list_fields(dynamodb):
+    """
+    Returns the sorted IDs of all registered fields, or an empty list if there is no registry table.
+    """
+    field_ids = []
+    scan_params = {'TableName': FIELD_REGISTRY_TABLE, 'ProjectionExpression': 'field_id'}
+    try:
+        while True:
+            response = dynamodb.scan(**scan_params)
+            field_ids.extend(item['field_id']['S'] for item in response.get('Items', []))
+
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceNotFoundException':
+            return []
+        raise
+
+    return sorted(field_ids)
+
+
+def list_field_sensors(dynamodb, field_id):
+    """
+    Returns the sorted IDs of the sensors registered for a field.
+    """
+    response = dynamodb.get_item(
+        TableName=FIELD_REGISTRY_TABLE,
+        Key={'field_id': {'S': field_id}},
+        ProjectionExpression='sensor_ids'
+    )
+    return sorted(response.get('Item', {}).get('sensor_ids', {}).get('SS', []))
+
+
+def should_fan_out(field_ids):
+    return FAN_OUT_MIN_FIELDS > 0 and len(field_ids) >= FAN_OUT_MIN_FIELDS
+
+
+def invoke_worker(function_name, payload):
+    global worker_client
+    if worker_client is None:
+        worker_client = boto3.client('lambda', config=CLIENT_CONFIG.merge(Config(
+            read_timeout=WORKER_TIMEOUT_SECONDS + 5,
+            retries={'mode': 'standard', 'max_attempts': 1},
+            max_pool_connections=MAX_PARALLEL_WORKERS,
+        )))
+
+    response = worker_client.invoke(FunctionName=function_name, InvocationType='RequestResponse', Payload=json.dumps(payload))
+    result = json.loads(response['Payload'].read())
+    if 'FunctionError' in response:
+        raise RuntimeError(f"Worker failed: {result.get('errorMessage', result)}")
+    return result
+
+
+def invoke_workers(function_name, payloads):
+    """
+    Invokes one worker per payload in parallel and waits for all of them. Returns the results in the
+    order of the payloads, with the exception in place of the result of a failed worker.
+    """
+    def invoke(payload):
+        try:
+            return invoke_worker(function_name, payload)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max(min(MAX_PARALLEL_WORKERS, len(payloads)), 1)) as executor:
+        return list(executor.map(invoke, payloads))
@@ -0,0 +1,133 @@
+import json
+from datetime import datetime
+
+# Optional binary encodings, only needed when they are used
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+ENCODINGS = ['json', 'msgpack', 'cbor']
+
+# First byte of binary payloads. JSON payloads have no header and always start with '{'
+FORMAT_HEADERS = {
+    'msgpack': b'\x01',
+    'cbor': b'\x02',
+}
+
+# Short keys used by the compact encodings
+SHORT_KEYS = {
+    'sensor_type': 'y',
+    'sensor_id': 'i',
+    'timestamp': 't',
+    'location': 'l',
+    'lon': 'o',
+    'lat': 'a',
+    'longitude': 'O',
+    'latitude': 'A',
+    'geo_position': 'g',
+    'humidity': 'h',
+    'temperature': 'c',
+    'soil_moisture': 'm',
+}
+LONG_KEYS = {short: long for long, short in SHORT_KEYS.items()}
+
+FRAME_KEY = 'readings'  # Key of the reading list in JSON frames
+COMPACT_FRAME_KEY = 'r'
+
+
+def shorten_keys(reading):
+    return {
+        SHORT_KEYS.get(key, key): shorten_keys(value) if isinstance(value, dict) else value
+        for key, value in reading.items()
+    }
+
+
+def expand_keys(reading):
+    return {
+        LONG_KEYS.get(key, key): expand_keys(value) if isinstance(value, dict) else value
+        for key, value in reading.items()
+    }
+
+
+def compact_reading(reading):
+    """
+    Converts a sensor message into its compact form with short keys and an epoch timestamp.
+    """
+    compact = shorten_keys(reading)
+    timestamp = compact.get('t')
+    if isinstance(timestamp, str):
+        compact['t'] = int(datetime.fromisoformat(timestamp).timestamp())
+    return compact
+
+
+def encode_readings(readings, encoding='json'):
+    """
+    Encodes one or more sensor messages into a single MQTT payload.
+    A single message is encoded as is, several messages are wrapped into a frame.
+    """
+    if encoding == 'json':
+        document = readings[0] if len(readings) == 1 else {FRAME_KEY: readings}
+        return json.dumps(document).encode()
+
+    compact = [compact_reading(reading) for reading in readings]
+    document = compact[0] if len(compact) == 1 else {COMPACT_FRAME_KEY: compact}
+
+    if encoding == 'msgpack':
+        if msgpack is None:
+            raise ValueError('The msgpack encoding requires the msgpack package')
+        return FORMAT_HEADERS['msgpack'] + msgpack.packb(document, use_bin_type=True)
+
+    if encoding == 'cbor':
+        if cbor2 is None:
+            raise ValueError('The cbor encoding requires the cbor2 package')
+        return FORMAT_HEADERS['cbor'] + cbor2.dumps(document)
+
+    raise ValueError(f'Unknown payload encoding {encoding}')
+
+
+def detect_encoding(data):
+    if data[:1] == FORMAT_HEADERS['msgpack']:
+        return 'msgpack'
+    if data[:1] == FORMAT_HEADERS['cbor']:
+        return 'cbor'
+    return 'json'
+
+
+def decode_document(document):
+    """
+    Returns the list of sensor messages of an already parsed single message or frame.
+    """
+    if FRAME_KEY in document:
+        return document[FRAME_KEY]
+    if COMPACT_FRAME_KEY in document:
+        return [expand_keys(reading) for reading in document[COMPACT_FRAME_KEY]]
+    if 'i' in document:
+        return [expand_keys(document)]
+    return [document]
+
+
+def decode_readings(data):
+    """
+    Decodes an MQTT payload in any supported encoding into a list of sensor messages.
+    Compact messages keep their epoch timestamps.
+    """
+    encoding = detect_encoding(data)
+
+    if encoding == 'msgpack':
+        if msgpack is None:
+            raise ValueError('Received a msgpack payload, but the msgpack package is not installed')
+        document = msgpack.unpackb(data[1:], raw=False)
+    elif encoding == 'cbor':
+        if cbor2 is None:
+            raise ValueError('Received a cbor payload, but the cbor2 package is not installed')
+        document = cbor2.loads(data[1:])
+    else:
+        document = json.loads(data)
+
+    return decode_document(document)
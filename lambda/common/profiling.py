@@ -0,0 +1,139 @@
+import cProfile
+import functools
+import io
+import json
+import logging
+import random
+import resource as rusage
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from runtime import client, env
+
+# Config
+PROFILE_MODE = env('PROFILE_MODE', 'off')  # off, cprofile or tracemalloc
+PROFILE_SAMPLE_RATE = env('PROFILE_SAMPLE_RATE', 1.0, float)  # Share of invocations profiled when a mode is set
+PROFILE_BUCKET = env('PROFILE_BUCKET')  # Profiles are written to /tmp if not set
+PROFILE_PREFIX = env('PROFILE_PREFIX', 'profiles/')
+PROFILE_TOP_ENTRIES = env('PROFILE_TOP_ENTRIES', 30, int)  # Entries in the tracemalloc report
+
+PROFILE_MODES = ['off', 'cprofile', 'tracemalloc']
+
+logger = logging.getLogger()
+
+# Wall time per phase of the current invocation
+phase_times = {}
+phase_lock = threading.Lock()
+
+
+@contextmanager
+def phase(name):
+    """
+    Measures the wall time of a phase of the invocation, like 'dynamodb', 's3', 'rendering' or 'telegram'.
+    Repeated phases add up. Phases running in parallel threads add up as well, so a parallel
+    section is timed once around the whole section, not inside its threads.
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start_time
+        with phase_lock:
+            phase_times[name] = phase_times.get(name, 0) + elapsed
+
+
+def write_profile(function_name, request_id, extension, content):
+    """
+    Writes a profile to S3, or to /tmp if no bucket is configured. Returns its location.
+    """
+    file_name = f"{function_name}/{time.strftime('%Y-%m-%d_%H-%M-%S')}_{request_id}.{extension}"
+
+    if PROFILE_BUCKET:
+        key = f"{PROFILE_PREFIX}{file_name}"
+        client('s3').put_object(Bucket=PROFILE_BUCKET, Key=key, Body=content)
+        return f"s3://{PROFILE_BUCKET}/{key}"
+
+    path = f"/tmp/{file_name.replace('/', '_')}"
+    with open(path, 'wb') as file:
+        file.write(content)
+    return path
+
+
+def cprofile_content(profiler):
+    """Returns the profile in the binary pstats format, readable with pstats or snakeviz."""
+    path = '/tmp/profile.pstats'
+    profiler.dump_stats(path)
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def tracemalloc_content(snapshot):
+    """Returns a text report of the lines that allocated the most memory."""
+    report = io.StringIO()
+    for stat in snapshot.statistics('lineno')[:PROFILE_TOP_ENTRIES]:
+        report.write(f"{stat}\n")
+    return report.getvalue().encode()
+
+
+def profiled_handler(handler):
+    """
+    Decorates a Lambda handler to profile a sample of its invocations, set by PROFILE_MODE
+    and PROFILE_SAMPLE_RATE. A sampled invocation writes a cProfile or tracemalloc profile
+    and logs one JSON summary line with the phase times and the peak memory.
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        phase_times.clear()
+
+        if PROFILE_MODE not in PROFILE_MODES:
+            logger.warning(f"Unknown PROFILE_MODE '{PROFILE_MODE}', use one of {', '.join(PROFILE_MODES)}")
+            return handler(event, context)
+
+        if PROFILE_MODE == 'off' or random.random() >= PROFILE_SAMPLE_RATE:
+            return handler(event, context)
+
+        profiler = None
+        if PROFILE_MODE == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            tracemalloc.start()
+
+        start_time = time.perf_counter()
+        try:
+            return handler(event, context)
+        finally:
+            duration = time.perf_counter() - start_time
+            function_name = getattr(context, 'function_name', handler.__module__)
+            request_id = getattr(context, 'aws_request_id', 'local')
+
+            if profiler is not None:
+                profiler.disable()
+                # Max resident set size of the container in KB
+                peak_memory_kb = rusage.getrusage(rusage.RUSAGE_SELF).ru_maxrss
+                extension, content = 'pstats', cprofile_content(profiler)
+            else:
+                snapshot = tracemalloc.take_snapshot()
+                peak_memory_kb = tracemalloc.get_traced_memory()[1] // 1024
+                tracemalloc.stop()
+                extension, content = 'txt', tracemalloc_content(snapshot)
+
+            try:
+                location = write_profile(function_name, request_id, extension, content)
+            except Exception as e:
+                location = None
+                logger.error(f"Failed to write profile: {str(e)}")
+
+            logger.info(json.dumps({
+                "profile": PROFILE_MODE,
+                "function": function_name,
+                "request_id": request_id,
+                "duration_ms": round(duration * 1000, 1),
+                "phases_ms": {name: round(seconds * 1000, 1) for name, seconds in phase_times.items()},
+                "peak_memory_kb": peak_memory_kb,
+                "location": location,
+            }))
+
+    return wrapper
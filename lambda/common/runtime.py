@@ -0,0 +1,99 @@
+import functools
+import logging
+import os
+import time
+
+# Taken before boto3 is imported, so the init time includes loading the SDK
+INIT_STARTED = time.perf_counter()
+
+import boto3
+from botocore.config import Config
+
+logger = logging.getLogger()
+
+
+def env(name, default=None, cast=str):
+    """
+    Reads a configuration value from the environment, or returns the default if it is not set.
+    """
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    return cast(value)
+
+
+def env_list(name, default=None):
+    """
+    Reads a comma separated list from the environment.
+    """
+    value = env(name)
+    if value is None:
+        return default if default is not None else []
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+# Client config
+MAX_POOL_CONNECTIONS = env('AWS_MAX_POOL_CONNECTIONS', 50, int)  # botocore defaults to 10
+MAX_RETRY_ATTEMPTS = env('AWS_MAX_RETRY_ATTEMPTS', 5, int)
+CONNECT_TIMEOUT_SECONDS = env('AWS_CONNECT_TIMEOUT_SECONDS', 5, float)
+READ_TIMEOUT_SECONDS = env('AWS_READ_TIMEOUT_SECONDS', 30, float)
+
+CLIENT_CONFIG = Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    retries={'mode': 'adaptive', 'max_attempts': MAX_RETRY_ATTEMPTS},
+    tcp_keepalive=True,
+    connect_timeout=CONNECT_TIMEOUT_SECONDS,
+    read_timeout=READ_TIMEOUT_SECONDS,
+)
+
+# One client/resource per service and container, shared by all modules and warm invocations
+clients = {}
+resources = {}
+
+
+def client(service_name):
+    """
+    Returns the shared boto3 client for the service, creating it on first use.
+    """
+    if service_name not in clients:
+        clients[service_name] = boto3.client(service_name, config=CLIENT_CONFIG)
+    return clients[service_name]
+
+
+def resource(service_name):
+    """
+    Returns the shared boto3 resource for the service, creating it on first use.
+    """
+    if service_name not in resources:
+        resources[service_name] = boto3.resource(service_name, config=CLIENT_CONFIG)
+    return resources[service_name]
+
+
+init_duration = None  # Seconds from loading this module to the first invocation, set on cold start
+invocation_count = 0
+
+
+def timed_handler(handler):
+    """
+    Decorates a Lambda handler to log the init time on cold starts and the duration of every invocation.
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global init_duration, invocation_count
+
+        start_time = time.perf_counter()
+        cold_start = invocation_count == 0
+        if cold_start:
+            init_duration = start_time - INIT_STARTED
+        invocation_count += 1
+
+        try:
+            return handler(event, context)
+        finally:
+            duration = time.perf_counter() - start_time
+            if cold_start:
+                logger.info(f"Cold start: init {round(init_duration * 1000, 1)}ms, invocation {round(duration * 1000, 1)}ms")
+            else:
+                logger.info(f"Warm invocation #{invocation_count}: {round(duration * 1000, 1)}ms")
+
+    return wrapper
@@ -0,0 +1,270 @@
+import math
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+from runtime import env
+
+# Config
+SENSOR_HEALTH_TABLE = env('SENSOR_HEALTH_TABLE', 'SensorHealth')
+HEALTH_FLUSH_INTERVAL_SECONDS = env('HEALTH_FLUSH_INTERVAL_SECONDS', 60, int)
+HEALTH_TTL_SECONDS = env('HEALTH_TTL_SECONDS', 2 * 24 * 60 * 60, int)  # Statistics of stopped workers expire
+
+STALE_AFTER_MINUTES = env('STALE_AFTER_MINUTES', 60, int)  # Sensors silent for longer are flagged
+SENTINEL_WINDOW_MINUTES = env('SENTINEL_WINDOW_MINUTES', 60, int)  # Readings without data are counted per window of this length
+# Identical readings in a row before a sensor counts as stuck. Best-effort: the run is counted per worker,
+# so it is only reliable where one long-running worker sees all readings of a sensor, like the ingest service
+STUCK_RUN_THRESHOLD = env('STUCK_RUN_THRESHOLD', 48, int)
+NOISE_STDDEV_THRESHOLDS = {  # Standard deviations above which a sensor counts as noisy
+    'humidity': env('NOISE_STDDEV_HUMIDITY', 25, float),
+    'soil_moisture': env('NOISE_STDDEV_SOIL_MOISTURE', 25, float),
+    'temperature': env('NOISE_STDDEV_TEMPERATURE', 15, float),
+}
+
+# Measurements that can never be negative. The simulator sends -1 when it has no data
+SENTINEL_PARAMETERS = ['humidity', 'soil_moisture']
+
+MAX_BATCH_WRITE_ITEMS = 25
+MAX_BATCH_WRITE_RETRIES = 5
+
+# Every container or process writes its own partial statistics, which are merged when read
+WORKER_ID = uuid.uuid4().hex
+
+
+def is_sentinel_reading(measurements):
+    """
+    Returns True if a normalized reading carries the -1 placeholder for missing data.
+    """
+    return any(measurements.get(parameter, 0) < 0 for parameter in SENTINEL_PARAMETERS)
+
+
+class RunningStats:
+    """
+    Mean and variance of a stream of values, updated in O(1) with Welford's algorithm.
+    """
+    __slots__ = ('count', 'mean', 'm2')
+
+    def __init__(self, count= 0, mean= 0.0, m2= 0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def update(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def merge(self, other):
+        """Combines the statistics of two disjoint streams (Chan et al.)."""
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+
+class SensorHealth:
+    """
+    Constant-memory health statistics of one sensor.
+    """
+    __slots__ = ('stats', 'last_seen', 'last_values', 'stuck_run', 'sentinel_count', 'sentinel_window')
+
+    def __init__(self):
+        self.stats = {}
+        self.last_seen = 0
+        self.last_values = None
+        self.stuck_run = 0
+        # Readings without data in the latest window with any, so old ones stop being flagged
+        self.sentinel_count = 0
+        self.sentinel_window = 0
+
+    def update(self, timestamp, measurements):
+        self.last_seen = max(self.last_seen, timestamp)
+
+        if is_sentinel_reading(measurements):
+            window = timestamp // (SENTINEL_WINDOW_MINUTES * 60)
+            if window > self.sentinel_window:
+                self.sentinel_count, self.sentinel_window = 0, window
+            if window == self.sentinel_window:
+                self.sentinel_count += 1
+            return
+
+        for parameter, value in measurements.items():
+            if parameter not in self.stats:
+                self.stats[parameter] = RunningStats()
+            self.stats[parameter].update(value)
+
+        self.stuck_run = self.stuck_run + 1 if measurements == self.last_values else 0
+        self.last_values = measurements
+
+    def merge(self, other):
+        for parameter, stats in other.stats.items():
+            self.stats.setdefault(parameter, RunningStats()).merge(stats)
+
+        # The run of identical values is only known for the worker that saw the latest reading. Runs that
+        # were split across Lambda containers are not added up, so stuck detection is best-effort
+        if other.last_seen > self.last_seen:
+            self.stuck_run = other.stuck_run
+            self.last_seen = other.last_seen
+
+        if other.sentinel_window > self.sentinel_window:
+            self.sentinel_count, self.sentinel_window = other.sentinel_count, other.sentinel_window
+        elif other.sentinel_window == self.sentinel_window:
+            self.sentinel_count += other.sentinel_count
+
+    def flags(self, now):
+        """
+        Returns the list of health problems of the sensor.
+        """
+        flags = []
+        if now - self.last_seen > STALE_AFTER_MINUTES * 60:
+            flags.append(f"silent for {round((now - self.last_seen) / 60)} minutes")
+        if self.stuck_run >= STUCK_RUN_THRESHOLD:
+            flags.append(f"stuck at the same value for {self.stuck_run + 1} readings")
+        for parameter, stats in self.stats.items():
+            threshold = NOISE_STDDEV_THRESHOLDS.get(parameter)
+            if threshold is not None and stats.stddev > threshold:
+                flags.append(f"noisy {parameter} (std. dev. {round(stats.stddev, 1)})")
+        # Only the current and the previous window count, a full window always lies within them
+        if self.sentinel_count and now // (SENTINEL_WINDOW_MINUTES * 60) - self.sentinel_window <= 1:
+            readings = "reading" if self.sentinel_count == 1 else "readings"
+            minutes = math.ceil((now - self.sentinel_window * SENTINEL_WINDOW_MINUTES * 60) / 60)
+            flags.append(f"{self.sentinel_count} {readings} without data in the last {minutes} minutes")
+        return flags
+
+    def to_item(self, sensor_id, worker_id):
+        return {
+            'sensor_id': {'S': sensor_id},
+            'worker_id': {'S': worker_id},
+            'last_seen': {'N': str(self.last_seen)},
+            'stuck_run': {'N': str(self.stuck_run)},
+            'sentinel_count': {'N': str(self.sentinel_count)},
+            'sentinel_window': {'N': str(self.sentinel_window)},
+            'stats': {'M': {
+                parameter: {'M': {
+                    'count': {'N': str(stats.count)},
+                    'mean': {'N': repr(stats.mean)},
+                    'm2': {'N': repr(stats.m2)},
+                }}
+                for parameter, stats in self.stats.items()
+            }},
+            'expires_at': {'N': str(int(time.time()) + HEALTH_TTL_SECONDS)},
+        }
+
+    @classmethod
+    def from_item(cls, item):
+        health = cls()
+        health.last_seen = int(item['last_seen']['N'])
+        health.stuck_run = int(item['stuck_run']['N'])
+        health.sentinel_count = int(item['sentinel_count']['N'])
+        # Counts written before the window was introduced are old
+        health.sentinel_window = int(item.get('sentinel_window', {'N': '0'})['N'])
+        for parameter, stats in item['stats']['M'].items():
+            stats = stats['M']
+            health.stats[parameter] = RunningStats(int(stats['count']['N']), float(stats['mean']['N']), float(stats['m2']['N']))
+        return health
+
+
+class SensorHealthTracker:
+    """
+    Keeps the health statistics of all sensors seen by this worker in memory, and writes
+    them to the health table at most once per flush interval instead of once per reading.
+    Statistics recorded since the last flush are lost when the worker stops without flushing,
+    e.g. when Lambda reclaims a container. Readings can be recorded while a flush runs in another thread.
+    """
+
+    def __init__(self, dynamodb, table_name= SENSOR_HEALTH_TABLE, flush_interval= HEALTH_FLUSH_INTERVAL_SECONDS, worker_id= WORKER_ID):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.flush_interval = flush_interval
+        self.worker_id = worker_id
+
+        self.sensors = {}
+        self.changed = set()
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def record(self, item):
+        """
+        Updates the statistics with a normalized sensor data item. Returns False for readings without data.
+        """
+        sensor_id = item['sensor_id']['S']
+        measurements = {
+            parameter: float(value['N'])
+            for parameter, value in item['measurements']['M'].items()
+        }
+
+        with self.lock:
+            health = self.sensors.get(sensor_id)
+            if health is None:
+                health = self.sensors[sensor_id] = SensorHealth()
+
+            health.update(int(item['timestamp']['N']), measurements)
+            self.changed.add(sensor_id)
+        return not is_sentinel_reading(measurements)
+
+    def maybe_flush(self):
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the statistics of all sensors that changed since the last flush.
+        """
+        with self.lock:
+            items = [self.sensors[sensor_id].to_item(sensor_id, self.worker_id) for sensor_id in self.changed]
+            self.changed = set()
+
+        for start in range(0, len(items), MAX_BATCH_WRITE_ITEMS):
+            requests = [{'PutRequest': {'Item': item}} for item in items[start:start + MAX_BATCH_WRITE_ITEMS]]
+            for attempt in range(MAX_BATCH_WRITE_RETRIES):
+                response = self.dynamodb.batch_write_item(RequestItems={self.table_name: requests})
+                requests = response.get('UnprocessedItems', {}).get(self.table_name, [])
+                if not requests:
+                    break
+                time.sleep(0.05 * 2 ** attempt)
+
+            # Statistics are cumulative, sensors that could not be written are written with the next flush
+            with self.lock:
+                for request in requests:
+                    self.changed.add(request['PutRequest']['Item']['sensor_id']['S'])
+
+        self.last_flush = time.monotonic()
+
+
+def load_sensor_health(dynamodb, table_name= SENSOR_HEALTH_TABLE):
+    """
+    Reads the partial statistics of all workers from the health table and merges them per sensor.
+    Returns an empty dict if there is no health table.
+    """
+    sensors = {}
+    scan_params = {'TableName': table_name}
+    while True:
+        try:
+            response = dynamodb.scan(**scan_params)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ResourceNotFoundException':
+                return {}
+            raise
+        for item in response.get('Items', []):
+            sensor_id = item['sensor_id']['S']
+            health = SensorHealth.from_item(item)
+            if sensor_id in sensors:
+                sensors[sensor_id].merge(health)
+            else:
+                sensors[sensor_id] = health
+
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    return sensors
@@ -1,57 +1,28 @@
 import json
 import logging
-from datetime import timezone
+from datetime import datetime, timezone
+from urllib.parse import unquote_plus
 from zoneinfo import ZoneInfo
 
-import boto3
 from botocore.exceptions import BotoCoreError, ClientError
+from idempotency import claim_event, complete_event, release_event
+from notifications import enqueue_notification
+from profiling import phase, profiled_handler
+from runtime import client, env, timed_handler
 
 # Config
-s3 = boto3.client('s3')
-lambda_client = boto3.client('lambda')
-dynamodb = boto3.client('dynamodb')
+s3 = client('s3')
 
-BUCKET_NAME = "heatmap-bucket-agrisense"
-TELEGRAM_LAMBDA_ARN = 'arn:aws:lambda:eu-north-1:881490115333:function:Telegram_Communication'
+BUCKET_NAME = env('BUCKET_NAME', "heatmap-bucket-agrisense")
+HEATMAP_PREFIX = env('HEATMAP_PREFIX', "heatmaps/sensor_heatmap_")
+LATEST_HEATMAP_POINTER_KEY = env('LATEST_HEATMAP_POINTER_KEY', "heatmaps/latest.json")  # Written by the visualization Lambda after every upload
+LOCAL_TIMEZONE = env('LOCAL_TIMEZONE', "Europe/Vienna")
 
-EVENT_IDEMPOTENCY_TABLE = 'EventIdempotencyTable'
-EVENT_IDEMPOTENCY_FUNCTION_NAME = "DeliveryVisualizationFunction"
+EVENT_IDEMPOTENCY_FUNCTION_NAME = env('EVENT_IDEMPOTENCY_FUNCTION_NAME', "DeliveryVisualizationFunction")
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
-def is_event_processed(pk, sk):
-    """
-    Check if the event with the given primary and sort key has already been processed.
-    """
-    try:
-        response = dynamodb.get_item(
-            TableName=EVENT_IDEMPOTENCY_TABLE,
-            Key={
-                'pk': {'S': pk},
-                'sk': {'S': sk}
-            }
-        )
-        return 'Item' in response
-    except Exception as e:
-        raise e
-
-
-def mark_event_as_processed(pk, sk):
-    """
-    Mark the event with the given primary and sort key as processed.
-    """
-    try:
-        dynamodb.put_item(
-            TableName=EVENT_IDEMPOTENCY_TABLE,
-            Item={
-                'pk': {'S': pk},
-                'sk': {'S': sk}
-            }
-        )
-    except Exception as e:
-        raise e
-
 def format_timestamp(timestamp):
     """
     Formats the timestamp in a more readable format for both UTC and local time.
@@ -59,80 +30,144 @@ def format_timestamp(timestamp):
     utc_time = timestamp.astimezone(timezone.utc)
     utc_formatted = utc_time.strftime("%A, %d %B %Y at %H:%M:%S UTC")
 
-    local_time = timestamp.astimezone(ZoneInfo("Europe/Vienna"))
+    local_time = timestamp.astimezone(ZoneInfo(LOCAL_TIMEZONE))
     local_formatted = local_time.strftime("%A, %d %B %Y at %H:%M:%S %Z")
 
     return utc_formatted, local_formatted
 
 
+def get_heatmap_from_event(event):
+    """
+    Returns the key and modification time of the heatmap that triggered the S3 event,
+    or None if the function was not invoked by an S3 event.
+    """
+    records = event.get('Records')
+    if not records or 's3' not in records[0]:
+        return None
+
+    record = records[0]
+    key = unquote_plus(record['s3']['object']['key'])
+    last_modified = datetime.fromisoformat(record['eventTime'].replace("Z", "+00:00"))
+    return key, last_modified
+
+
 def get_latest_heatmap():
     """
-    Fetches the latest heatmap file from the S3 bucket.
+    Fetches the latest heatmap file from the pointer object in the S3 bucket.
+    Falls back to listing all heatmaps if the pointer does not exist.
+    """
+    try:
+        response = s3.get_object(Bucket=BUCKET_NAME, Key=LATEST_HEATMAP_POINTER_KEY)
+        pointer = json.loads(response['Body'].read())
+        last_modified = datetime.fromisoformat(pointer['last_modified'])
+        logger.debug(f"Latest heatmap from pointer: {pointer['key']} (Last Modified: {last_modified})")
+        return pointer['key'], last_modified
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise RuntimeError(f"Failed to retrieve heatmap pointer from S3: {str(e)}")
+    except BotoCoreError as e:
+        raise RuntimeError(f"Failed to retrieve heatmap pointer from S3: {str(e)}")
+
+    logger.warning(f"No heatmap pointer at {LATEST_HEATMAP_POINTER_KEY}, listing the bucket instead")
+    return find_latest_heatmap()
+
+
+def find_latest_heatmap():
+    """
+    Finds the latest heatmap file by listing all heatmaps in the S3 bucket page by page.
     """
     try:
-        response = s3.list_objects_v2(Bucket=BUCKET_NAME)
-        files = response.get('Contents', [])
-        if not files:
+        latest_file = None
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=HEATMAP_PREFIX):
+            for file in page.get('Contents', []):
+                if latest_file is None or file['LastModified'] > latest_file['LastModified']:
+                    latest_file = file
+
+        if latest_file is None:
             raise FileNotFoundError("No heatmap files available in the bucket.")
-        latest_file = max(files, key=lambda x: x['LastModified'])
         logger.debug(f"Latest heatmap: {latest_file['Key']} (Last Modified: {latest_file['LastModified']})")
         return latest_file['Key'], latest_file['LastModified']
     except (BotoCoreError, ClientError) as e:
         raise RuntimeError(f"Failed to retrieve heatmap from S3: {str(e)}")
 
 
+@timed_handler
+@profiled_handler
 def lambda_handler(event, context):
     """
-    Lambda function to fetch the latest heatmap and send it via Telegram.
+    Lambda function to send the heatmap of the triggering S3 event, or the latest heatmap, via Telegram.
     """
     try:
         logger.info(f"Received event: {json.dumps(event, indent=2)}")
 
-        # Extract event details
-        sequencer = event['Records'][0]['s3']['object']['sequencer']
+        # Use the heatmap of the S3 event, or look up the latest one when invoked on demand
+        heatmap = get_heatmap_from_event(event)
+        if heatmap is not None:
+            latest_key, last_modified = heatmap
+            sequencer = event['Records'][0]['s3']['object']['sequencer']
+
+            if not latest_key.endswith('.png'):
+                logger.info(f"Ignoring event for non-heatmap object {latest_key}.")
+                return {
+                    "statusCode": 200,
+                    "body": json.dumps({"message": "Not a heatmap."})
+                }
+        else:
+            with phase('s3'):
+                latest_key, last_modified = get_latest_heatmap()
+            # Every on-demand request sends the heatmap, even if it was sent before. Keyed by the request,
+            # so only retries of the same asynchronous invocation are skipped
+            sequencer = f"request:{event.get('request_id') or context.aws_request_id}"
+
         pk = EVENT_IDEMPOTENCY_FUNCTION_NAME
         sk = sequencer
 
         logger.debug(f"Processing event with sequencer: {sequencer}")
 
-        # Check idempotency
-        if is_event_processed(pk, sk):
+        # Claim the event, so duplicates and concurrent retries skip it
+        with phase('idempotency'):
+            claimed = claim_event(pk, sk, context)
+        if not claimed:
             logger.info(f"Event with sequencer {sequencer} already processed for {pk}.")
             return {
                 "statusCode": 200,
                 "body": json.dumps({"message": "Event already processed."})
             }
 
-
-        latest_key, last_modified = get_latest_heatmap()
-        utc_formatted, local_formatted = format_timestamp(last_modified)
-
-        caption = (
-            f"The latest heatmap visualization of your field conditions is now available.\n\n"
-            f"🌐 UTC Time: {utc_formatted}\n"
-            f"🕒 Local Time: {local_formatted}\n\n"
-            f"Check for updates on soil moisture and temperature to plan your next steps!"
-        )
-
-        response = lambda_client.invoke(
-            FunctionName=TELEGRAM_LAMBDA_ARN,
-            InvocationType='RequestResponse',
-            Payload=json.dumps({
-                "action": "send_image",
-                "bucket_name": BUCKET_NAME,
-                "s3_key": latest_key,
-                "caption": caption
-            })
-        )
-        logger.debug(f"Telegram Lambda invoked successfully: {response}")
-
-        # Mark the event as processed
-        mark_event_as_processed(pk, sk)
+        try:
+            utc_formatted, local_formatted = format_timestamp(last_modified)
+
+            caption = (
+                f"The latest heatmap visualization of your field conditions is now available.\n\n"
+                f"🌐 UTC Time: {utc_formatted}\n"
+                f"🕒 Local Time: {local_formatted}\n\n"
+                f"Check for updates on soil moisture and temperature to plan your next steps!"
+            )
+
+            with phase('notification'):
+                enqueue_notification(
+                    action="send_image",
+                    payload={
+                        "bucket_name": BUCKET_NAME,
+                        "s3_key": latest_key,
+                        "caption": caption
+                    },
+                    dedup_key=f"{pk}:{sk}",
+                    group_id=pk
+                )
+        except Exception:
+            # Allow a retry of the event to process it again
+            release_event(pk, sk)
+            raise
+
+        with phase('idempotency'):
+            complete_event(pk, sk)
 
         return {
             "statusCode": 200,
             "body": json.dumps({
-                "message": f"Heatmap {latest_key} sent successfully.",
+                "message": f"Heatmap {latest_key} queued for delivery.",
                 "utc_timestamp": utc_formatted
             })
         }
@@ -1,12 +1,33 @@
+import base64
 import json
-import boto3
 from datetime import datetime, timezone
 
+import boto3
+from botocore.config import Config
+
+from partitioning import FieldRegistry, field_of
+from payload_codec import decode_document, decode_readings
+from profiling import phase, profiled_handler
+from runtime import CLIENT_CONFIG, client, env, timed_handler
+from sensor_health import SensorHealthTracker
+from write_controller import SPILL_QUEUE_URL, WriteController, write_deadline
+
 # Initialize the DynamoDB client
-dynamodb = boto3.client('dynamodb')
+dynamodb = client('dynamodb')
 
 # DynamoDB table name
-TABLE_NAME = 'Sensordata'
+TABLE_NAME = env('SENSOR_DATA_TABLE', 'Sensordata')
+
+# Adapts the writes to throttling and spills readings to the queue when the table is saturated.
+# Its client does not retry, so the controller sees every throttled request and owns the back-off
+write_client = boto3.client('dynamodb', config=CLIENT_CONFIG.merge(Config(retries={'mode': 'standard', 'max_attempts': 1})))
+write_controller = WriteController(write_client, TABLE_NAME, client('sqs') if SPILL_QUEUE_URL else None)
+
+# Running health statistics of the sensors seen by this container, flushed periodically
+health_tracker = SensorHealthTracker(dynamodb)
+
+# Fields this container wrote readings for, so the recommendation and visualization functions can fan out per field
+field_registry = FieldRegistry(dynamodb)
 
 def parse_geo_location_string( s: str ):
     if not s:
@@ -27,10 +48,14 @@ def normalize_sensor_data( event ):
     if not sensor_id or not timestamp or not sensor_type:
         raise ValueError(f"Error: Bad message {event}")
 
-    timestamp = int(datetime.fromisoformat(timestamp).timestamp())
+    # Compact messages already carry an epoch timestamp
+    if isinstance(timestamp, str):
+        timestamp = int(datetime.fromisoformat(timestamp).timestamp())
+    else:
+        timestamp = int(timestamp)
 
     if sensor_type == 'IoT-2000':
-        return {
+        item= {
             'sensor_type': {'S': sensor_type},
             'sensor_id': {'S': sensor_id},
             'timestamp': { 'N': str(timestamp) },
@@ -49,7 +74,7 @@ def normalize_sensor_data( event ):
         }
     elif sensor_type == 'sensormatic':
         lat, lon= parse_geo_location_string(event.get('geo_position'))
-        return {
+        item= {
             'sensor_type': {'S': sensor_type},
             'sensor_id': {'S': sensor_id},
             'timestamp': {'N': str(timestamp)},
@@ -67,7 +92,7 @@ def normalize_sensor_data( event ):
             }
         }
     elif sensor_type == 'MQTT-Master':
-        return {
+        item= {
             'sensor_type': {'S': sensor_type},
             'sensor_id': {'S': sensor_id},
             'timestamp': {'N': str(timestamp)},
@@ -87,27 +112,114 @@ def normalize_sensor_data( event ):
     else:
         raise ValueError('Unknown sensor type')
 
+    # Partition of the reading: the field registered on the sensor, or the grid cell of its location
+    location= item['location']['M']
+    item['field_id']= {'S': event.get('field_id') or field_of(location['lat']['N'], location['lon']['N'])}
+    return item
+
+
+def decode_event(event):
+    """
+    Returns the sensor messages contained in an IoT Core event. Supports single JSON messages,
+    JSON frames and binary payloads, which the IoT rule passes base64 encoded in 'payload'.
+    """
+    if 'payload' in event:
+        return decode_readings(base64.b64decode(event['payload']))
+    return decode_document(event)
+
+
+def write_items(items, deadline):
+    """
+    Saves the items into DynamoDB, using batch writes if there is more than one item.
+    Items that cannot be written before the deadline are spilled to the queue.
+    """
+    remaining= write_controller.write(items, deadline)
+    if remaining:
+        write_controller.spill(remaining)
+        print(f'Spilled {len(remaining)} of {len(items)} items, table is {write_controller.state}')
+
+
+def process_spilled_records(records, deadline):
+    """
+    Writes the items of an SQS batch from the spill queue. Records that cannot be written yet
+    are reported as failed, so SQS delivers them again after the visibility timeout.
+    """
+    failed_ids= []
+    for record in records:
+        try:
+            items= json.loads(record['body'])['items']
+            with phase('dynamodb'):
+                if write_controller.write(items, deadline):
+                    failed_ids.append(record['messageId'])
+        except Exception as e:
+            print(f"Error writing spilled record {record['messageId']}:", str(e))
+            failed_ids.append(record['messageId'])
+
+    if failed_ids:
+        print(f'{len(failed_ids)} of {len(records)} spilled records not written yet, table is {write_controller.state}')
 
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed_ids]}
+
+
+@timed_handler
+@profiled_handler
 def lambda_handler(event, context):
     """
     Handles incoming events from AWS IoT Core, logs the data, and saves it into DynamoDB.
     """
+    deadline= write_deadline(context)
+    function_name= getattr(context, 'function_name', 'ingest')
+
+    # Readings spilled while the table was saturated
+    records= event.get('Records')
+    if records and records[0].get('eventSource') == 'aws:sqs':
+        response= process_spilled_records(records, deadline)
+        write_controller.maybe_emit_metrics(function_name)
+        return response
+
     try:
         # Log the event data
         # print("Received event:", json.dumps(event, indent=2))
         
-        normalized_data= normalize_sensor_data(event)
+        normalized_data= [ normalize_sensor_data(reading) for reading in decode_event(event) ]
+    except Exception as e:
+        # Retrying cannot fix an event that cannot be decoded
+        print("Error:", str(e))
+        write_controller.maybe_emit_metrics(function_name)
+        return {
+            'statusCode': 500,
+            'body': json.dumps('Error processing data!')
+        }
+
+    try:
+        # Readings without data only count towards the sensor health, they are not stored
+        normalized_data= [ item for item in normalized_data if health_tracker.record(item) ]
+
+        # Save data into DynamoDB. Any error here fails the invocation, as the readings were neither
+        # written nor spilled: Lambda retries the event and finally hands it to the on-failure destination
+        with phase('dynamodb'):
+            if normalized_data:
+                write_items(normalized_data, deadline)
 
-        # Save data into DynamoDB
-        dynamodb.put_item(
-            TableName = TABLE_NAME,
-            Item = normalized_data
-        )
+        with phase('field_registry'):
+            try:
+                field_registry.register_items(normalized_data)
+            except Exception as e:
+                # Registered again with the next reading of the field
+                print("Error registering fields:", str(e))
+
+        with phase('sensor_health'):
+            try:
+                health_tracker.maybe_flush()
+            except Exception as e:
+                # Health statistics are cumulative and written again with the next flush
+                print("Error flushing sensor health:", str(e))
 
         utc_now= 1000 * datetime.now(timezone.utc).timestamp()
         event_time= event.get('received_time')
-        time_diff= utc_now - event_time
-        print( f'Stored event in {time_diff} ({event_time} -> {utc_now})')
+        if event_time is not None:
+            time_diff= utc_now - event_time
+            print( f'Stored {len(normalized_data)} readings in {time_diff} ({event_time} -> {utc_now})')
         
         return {
             'statusCode': 200,
@@ -115,7 +227,6 @@ def lambda_handler(event, context):
         }
     except Exception as e:
         print("Error:", str(e))
-        return {
-            'statusCode': 500,
-            'body': json.dumps('Error processing data!')
-        }
+        raise
+    finally:
+        write_controller.maybe_emit_metrics(function_name)
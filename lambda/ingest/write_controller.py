@@ -0,0 +1,233 @@
+import json
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from runtime import env
+
+# Config
+MAX_WRITE_ATTEMPTS = env('MAX_WRITE_ATTEMPTS', 8, int)  # Attempts per batch before its items are spilled
+MAX_WRITE_SECONDS = env('MAX_WRITE_SECONDS', 10, float)  # Time budget of an invocation for writing
+SPILL_RESERVE_SECONDS = env('SPILL_RESERVE_SECONDS', 2, float)  # Kept free before the Lambda timeout to spill
+BASE_BACKOFF_SECONDS = env('BASE_BACKOFF_SECONDS', 0.05, float)
+MAX_BACKOFF_SECONDS = env('MAX_BACKOFF_SECONDS', 2, float)
+SATURATION_THROTTLE_RATE = env('SATURATION_THROTTLE_RATE', 0.5, float)  # Share of throttled writes above which the table counts as saturated
+SATURATION_COOLDOWN_SECONDS = env('SATURATION_COOLDOWN_SECONDS', 1, float)  # Writes are spilled right away while saturated
+SPILL_QUEUE_URL = env('SPILL_QUEUE_URL')  # Without a queue, unwritten readings fail the invocation
+METRICS_NAMESPACE = env('METRICS_NAMESPACE', 'SensorIngest')
+METRICS_INTERVAL_SECONDS = env('METRICS_INTERVAL_SECONDS', 60, int)
+
+THROTTLING_ERRORS = {'ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded'}
+THROTTLED_RATE = 0.01  # Throttle rate below which the table counts as healthy
+EWMA_WEIGHT = 0.2  # Weight of the latest write in the throttle rate and latency averages
+
+MAX_BATCH_WRITE_ITEMS = 25  # Limit of DynamoDB BatchWriteItem
+MAX_SQS_BATCH_ENTRIES = 10  # Limit of SQS SendMessageBatch
+
+
+class TableSaturatedError(Exception):
+    """
+    Raised when readings could neither be written nor spilled.
+    """
+
+
+def write_deadline(context, max_seconds= MAX_WRITE_SECONDS):
+    """
+    Returns the monotonic time until which an invocation may keep retrying writes,
+    leaving enough time before the Lambda timeout to spill what is left.
+    """
+    seconds = max_seconds
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        seconds = min(seconds, context.get_remaining_time_in_millis() / 1000 - SPILL_RESERVE_SECONDS)
+    return time.monotonic() + max(seconds, 0)
+
+
+class WriteController:
+    """
+    Writes items to a DynamoDB table and adapts to throttling. Tracks the share of throttled
+    writes and the write latency, paces the writes of a throttled table with a jittered back-off
+    and reports a saturated table, so callers spill their items instead of waiting for it.
+    The state is kept per container and shared by all its invocations.
+    """
+
+    def __init__(self, dynamodb, table_name, sqs= None, spill_queue_url= SPILL_QUEUE_URL):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.sqs = sqs
+        self.spill_queue_url = spill_queue_url
+
+        self.throttle_rate = 0.0
+        self.latency = 0.0
+        self.backoff = 0.0
+        self.saturated_until = 0.0
+
+        self.request_count = 0
+        self.written_count = 0
+        self.throttled_count = 0
+        self.spilled_count = 0
+        self.lock = threading.Lock()
+
+        self.last_metrics = time.monotonic()
+        self.emitted_counts = self.counts()
+
+    @property
+    def saturated(self):
+        return time.monotonic() < self.saturated_until
+
+    @property
+    def state(self):
+        if self.saturated:
+            return 'saturated'
+        return 'throttled' if self.throttle_rate >= THROTTLED_RATE else 'healthy'
+
+    def write(self, items, deadline):
+        """
+        Writes the items in batches until the deadline. Returns the items that were not written,
+        because the table is saturated, the deadline passed or the attempts are used up.
+        """
+        remaining = []
+        for start in range(0, len(items), MAX_BATCH_WRITE_ITEMS):
+            batch = items[start:start + MAX_BATCH_WRITE_ITEMS]
+
+            for _ in range(MAX_WRITE_ATTEMPTS):
+                if self.saturated or time.monotonic() >= deadline:
+                    break
+                self.pace(deadline)
+                batch = self.send(batch)
+                if not batch:
+                    break
+
+            remaining.extend(batch)
+        return remaining
+
+    def pace(self, deadline):
+        """Waits for a random share of the current back-off (full jitter), so throttled writers do not retry in lock-step."""
+        if self.backoff:
+            time.sleep(min(random.uniform(0, self.backoff), max(deadline - time.monotonic(), 0)))
+
+    def send(self, items):
+        """
+        Sends one write request. Returns the items that were throttled.
+        """
+        start_time = time.perf_counter()
+        try:
+            if len(items) == 1:
+                self.dynamodb.put_item(TableName=self.table_name, Item=items[0])
+                unprocessed = []
+            else:
+                response = self.dynamodb.batch_write_item(RequestItems={
+                    self.table_name: [{'PutRequest': {'Item': item}} for item in items]
+                })
+                unprocessed = [
+                    request['PutRequest']['Item']
+                    for request in response.get('UnprocessedItems', {}).get(self.table_name, [])
+                ]
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in THROTTLING_ERRORS:
+                raise
+            unprocessed = items
+
+        self.record(len(items), len(unprocessed), time.perf_counter() - start_time)
+        return unprocessed
+
+    def record(self, sent, throttled, latency):
+        with self.lock:
+            self.request_count += 1
+            self.written_count += sent - throttled
+            self.throttled_count += throttled
+
+            self.throttle_rate += EWMA_WEIGHT * (throttled / sent - self.throttle_rate)
+            self.latency += EWMA_WEIGHT * (latency - self.latency)
+
+            # Back off exponentially while throttled, and recover gradually once writes go through
+            if throttled:
+                self.backoff = min(max(2 * self.backoff, BASE_BACKOFF_SECONDS), MAX_BACKOFF_SECONDS)
+            else:
+                self.backoff = self.backoff / 2 if self.backoff > BASE_BACKOFF_SECONDS else 0.0
+
+            if self.throttle_rate >= SATURATION_THROTTLE_RATE:
+                self.saturated_until = time.monotonic() + SATURATION_COOLDOWN_SECONDS
+
+    def spill(self, items):
+        """
+        Sends unwritten items to the spill queue, which feeds them back to the ingest Lambda later.
+        Raises TableSaturatedError if there is no queue or it does not accept them.
+        """
+        if not self.spill_queue_url:
+            raise TableSaturatedError(f"Could not write {len(items)} items to {self.table_name} and no spill queue is configured")
+
+        bodies = [
+            json.dumps({'items': items[start:start + MAX_BATCH_WRITE_ITEMS]})
+            for start in range(0, len(items), MAX_BATCH_WRITE_ITEMS)
+        ]
+        for start in range(0, len(bodies), MAX_SQS_BATCH_ENTRIES):
+            entries = [
+                {'Id': str(index), 'MessageBody': body}
+                for index, body in enumerate(bodies[start:start + MAX_SQS_BATCH_ENTRIES])
+            ]
+            response = self.sqs.send_message_batch(QueueUrl=self.spill_queue_url, Entries=entries)
+            if response.get('Failed'):
+                raise TableSaturatedError(f"Could not spill {len(response['Failed'])} messages to {self.spill_queue_url}")
+
+        with self.lock:
+            self.spilled_count += len(items)
+
+    def counts(self):
+        return {
+            'Requests': self.request_count,
+            'WrittenItems': self.written_count,
+            'ThrottledItems': self.throttled_count,
+            'SpilledItems': self.spilled_count,
+        }
+
+    def metrics(self):
+        """
+        Returns the current state and the counters since the container started.
+        """
+        return {
+            'state': self.state,
+            'throttle_rate': round(self.throttle_rate, 3),
+            'latency_ms': round(self.latency * 1000, 1),
+            'backoff_ms': round(self.backoff * 1000, 1),
+            'requests': self.request_count,
+            'written': self.written_count,
+            'throttled': self.throttled_count,
+            'spilled': self.spilled_count,
+        }
+
+    def maybe_emit_metrics(self, function_name):
+        """
+        Logs the metrics in the CloudWatch embedded metric format at most once per interval.
+        CloudWatch turns the log line into metrics, without an extra API call.
+        """
+        now = time.monotonic()
+        if now - self.last_metrics < METRICS_INTERVAL_SECONDS:
+            return
+        self.last_metrics = now
+
+        counts = self.counts()
+        values = {name: counts[name] - self.emitted_counts[name] for name in counts}
+        self.emitted_counts = counts
+        values.update({
+            'ThrottleRate': self.throttle_rate,
+            'WriteLatency': self.latency * 1000,
+            'Backoff': self.backoff * 1000,
+            'Saturated': int(self.saturated),
+        })
+
+        units = {'WriteLatency': 'Milliseconds', 'Backoff': 'Milliseconds'}
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['FunctionName']],
+                    'Metrics': [{'Name': name, 'Unit': units.get(name, 'Count' if name in counts else 'None')} for name in values],
+                }],
+            },
+            'FunctionName': function_name,
+            'State': self.state,
+            **values,
+        }))
@@ -2,19 +2,24 @@ import json
 import logging
 from datetime import datetime, timedelta
 
-import boto3
+from idempotency import claim_event, complete_event, release_event
+from notifications import enqueue_notification
+from partitioning import FIELD_INDEX_NAME, invoke_workers, list_fields, should_fan_out
+from profiling import phase, profiled_handler
+from runtime import client, env, timed_handler
+from sensor_health import load_sensor_health
 
 # General Config
-dynamodb = boto3.client('dynamodb')
-lambda_client = boto3.client('lambda')
-SENSOR_DATA_TABLE = 'Sensordata'
+dynamodb = client('dynamodb')
+SENSOR_DATA_TABLE = env('SENSOR_DATA_TABLE', 'Sensordata')
 
-TELEGRAM_LAMBDA_ARN = 'arn:aws:lambda:eu-north-1:881490115333:function:Telegram_Communication'
+EVENT_IDEMPOTENCY_FUNCTION_NAME = env('EVENT_IDEMPOTENCY_FUNCTION_NAME', 'RecommendationFunction')
+WORKER_FUNCTION_NAME = env('WORKER_FUNCTION_NAME')  # Function analyzing a single field, defaults to this function
 
-EVENT_IDEMPOTENCY_TABLE = 'EventIdempotencyTable'
-EVENT_IDEMPOTENCY_FUNCTION_NAME = 'RecommendationFunction'
-
-TIME_WINDOW_MINUTES = 30  # Time windows for the analysis = now - TIME_WINDOW_MINUTES -> analysis in DB
+TIME_WINDOW_MINUTES = env('TIME_WINDOW_MINUTES', 30, int)  # Time windows for the analysis = now - TIME_WINDOW_MINUTES -> analysis in DB
+# Sensors in deadband mode only report changes and a heartbeat. Their last reading stays current for this long
+HEARTBEAT_INTERVAL_MINUTES = env('HEARTBEAT_INTERVAL_MINUTES', 15, int)
+MAX_HEALTH_WARNINGS = env('MAX_HEALTH_WARNINGS', 10, int)  # Sensors listed one by one, the others are summarised in one line
 
 # Sensor Type Config
 SENSOR_CONFIG = {
@@ -72,54 +77,40 @@ logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
 
-def is_event_processed(pk, sk):
-    """
-    Check if the event with the given primary and sort key has already been processed.
-    """
-    try:
-        response = dynamodb.get_item(
-            TableName=EVENT_IDEMPOTENCY_TABLE,
-            Key={
-                'pk': {'S': pk},
-                'sk': {'S': sk}
-            }
-        )
-        return 'Item' in response
-    except Exception as e:
-        raise e
+def health_problem(flag):
+    """Returns the kind of a health flag, like 'silent' or 'stuck', to count them in the summary."""
+    return "without data" if "without data" in flag else flag.split()[0]
 
 
-def mark_event_as_processed(pk, sk):
+def generate_health_warnings(sensor_health, trigger_time):
     """
-    Mark the event with the given primary and sort key as processed.
+    Generate warnings for stale, stuck, noisy or incomplete sensors from their health statistics.
+    Only the first MAX_HEALTH_WARNINGS sensors are listed, the others are counted per problem in one line.
     """
-    try:
-        dynamodb.put_item(
-            TableName=EVENT_IDEMPOTENCY_TABLE,
-            Item={
-                'pk': {'S': pk},
-                'sk': {'S': sk}
-            }
-        )
-    except Exception as e:
-        raise e
-
+    now = int(trigger_time.timestamp())
+    warnings = []
+    problem_counts = {}
+    remaining = 0
+    for sensor_id, health in sorted(sensor_health.items()):
+        flags = health.flags(now)
+        if not flags:
+            continue
+        if len(warnings) < MAX_HEALTH_WARNINGS:
+            warnings.append(f"⚠️ {sensor_id}: {', '.join(flags)}.")
+            continue
+        remaining += 1
+        for flag in flags:
+            problem = health_problem(flag)
+            problem_counts[problem] = problem_counts.get(problem, 0) + 1
 
-def invoke_telegram_lambda(action, payload):
-    """Invoke the Telegram Lambda function with the specified action and payload."""
-    try:
-        response = lambda_client.invoke(
-            FunctionName=TELEGRAM_LAMBDA_ARN,
-            InvocationType='RequestResponse',
-            Payload=json.dumps({"action": action, **payload})
-        )
-        logger.debug(f"Telegram Lambda invoked with action: {action}, response: {response}")
-    except Exception as e:
-        raise e
+    if remaining:
+        summary = ", ".join(f"{count} {problem}" for problem, count in sorted(problem_counts.items()))
+        warnings.append(f"⚠️ {remaining} more sensors with warnings: {summary}.")
+    return warnings
 
 
-def generate_combined_recommendations(sensor_items):
-    """Generate a combined recommendation message for all sensors."""
+def generate_recommendations(sensor_items):
+    """Generate the recommendation lines for the given sensors."""
     recommendations = []
     for sensor_data in sensor_items:
         sensor_type = sensor_data['sensor_type']['S']
@@ -145,6 +136,11 @@ def generate_combined_recommendations(sensor_items):
                         f"{config['high_message'].format(location=location_string, value=value)}"
                     )
 
+    return recommendations
+
+
+def combine_recommendations(recommendations):
+    """Combine the recommendation lines into one message."""
     # Testing Purposes
     if not recommendations:
         return "(TESTING!) ✅ All sensors are operating within normal parameters."
@@ -152,29 +148,103 @@ def generate_combined_recommendations(sensor_items):
     return "\n\n".join(recommendations)
 
 
-def get_recent_sensor_data(trigger_time):
-    """Fetch sensor data from the DynamoDB table based on the configured timeframe."""
+def get_recent_sensor_data(trigger_time, field_id=None):
+    """
+    Fetch the latest reading of every sensor from the DynamoDB table based on the configured timeframe.
+    The last stored value of a sensor is current until the next change or heartbeat, so the
+    timeframe covers at least one heartbeat interval.
+    With a field ID, only the sensors of that field are read through the field index instead of scanning the table.
+    """
     try:
-        start_time_epoch = int((trigger_time - timedelta(minutes=TIME_WINDOW_MINUTES)).timestamp())
+        window_minutes = max(TIME_WINDOW_MINUTES, HEARTBEAT_INTERVAL_MINUTES)
+        start_time_epoch = int((trigger_time - timedelta(minutes=window_minutes)).timestamp())
 
-        response = dynamodb.scan(
-            TableName=SENSOR_DATA_TABLE,
-            FilterExpression='#ts >= :start_time',
-            ExpressionAttributeNames={
+        params = {
+            'TableName': SENSOR_DATA_TABLE,
+            'ExpressionAttributeNames': {
                 '#ts': 'timestamp'  # Alias for "timestamp"
             },
-            ExpressionAttributeValues={
+            'ExpressionAttributeValues': {
                 ':start_time': {'N': str(start_time_epoch)}
             }
-        )
-        return response.get('Items', [])
+        }
+        if field_id is None:
+            params['FilterExpression'] = '#ts >= :start_time'
+            read = dynamodb.scan
+        else:
+            params['IndexName'] = FIELD_INDEX_NAME
+            params['KeyConditionExpression'] = 'field_id = :field_id AND #ts >= :start_time'
+            params['ExpressionAttributeValues'][':field_id'] = {'S': field_id}
+            read = dynamodb.query
+
+        latest_items = {}
+        while True:
+            response = read(**params)
+            for item in response.get('Items', []):
+                sensor_id = item['sensor_id']['S']
+                latest = latest_items.get(sensor_id)
+                if latest is None or int(item['timestamp']['N']) > int(latest['timestamp']['N']):
+                    latest_items[sensor_id] = item
+
+            if 'LastEvaluatedKey' not in response:
+                break
+            params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        return list(latest_items.values())
     except Exception as e:
         logger.error(f"Error querying DynamoDB: {str(e)}")
         raise
 
 
+def analyze_field(event):
+    """Worker: evaluates the sensors of one field and returns their recommendation lines to the coordinator."""
+    trigger_time = datetime.fromisoformat(event['time'].replace("Z", "+00:00"))
+
+    with phase('dynamodb'):
+        sensor_items = get_recent_sensor_data(trigger_time, event['field_id'])
+
+    return {
+        "field_id": event['field_id'],
+        "sensor_count": len(sensor_items),
+        "recommendations": generate_recommendations(sensor_items),
+    }
+
+
+def analyze_fields(field_ids, trigger_time_str, context):
+    """
+    Coordinator: invokes one worker per field in parallel and merges their recommendations in field order.
+    Fields whose worker failed are reported instead of failing the whole digest.
+    """
+    function_name = WORKER_FUNCTION_NAME or context.function_name
+    with phase('fan_out'):
+        results = invoke_workers(function_name, [
+            {"mode": "field", "field_id": field_id, "time": trigger_time_str}
+            for field_id in field_ids
+        ])
+
+    recommendations = []
+    for field_id, result in zip(field_ids, results):
+        if isinstance(result, Exception):
+            logger.error(f"Worker for field {field_id} failed: {str(result)}")
+            recommendations.append(f"⚠️ {field_id}: Sensors could not be analyzed.")
+        else:
+            recommendations.extend(result['recommendations'])
+
+    logger.info(f"Merged the recommendations of {len(field_ids)} fields")
+    return recommendations
+
+
+@timed_handler
+@profiled_handler
 def lambda_handler(event, context):
-    """Lambda function to fetch data from DynamoDB and evaluate/analyze recommendations."""
+    """
+    Lambda function to fetch data from DynamoDB and evaluate/analyze recommendations.
+    Large fleets are analyzed by one worker invocation of this function per field.
+    """
+    # Worker invocations fail as a whole, so the coordinator sees the error
+    if event.get('mode') == 'field':
+        return analyze_field(event)
+
     try:
         logger.info(f"Received event: {json.dumps(event, indent=2)}")
 
@@ -183,32 +253,57 @@ def lambda_handler(event, context):
         pk = EVENT_IDEMPOTENCY_FUNCTION_NAME
         sk = event_id
 
-        # Check idempotency
-        if is_event_processed(pk, sk):
+        # Claim the event, so duplicates and concurrent retries skip it
+        with phase('idempotency'):
+            claimed = claim_event(pk, sk, context)
+        if not claimed:
             logger.info(f"Event with ID {event_id} already processed for {pk}.")
             return {
                 "statusCode": 200,
                 "body": json.dumps({"message": "Event already processed."})
             }
 
-        # Get trigger time from event bridge trigger
-        trigger_time_str = event['time']
-        trigger_time = datetime.fromisoformat(trigger_time_str.replace("Z", "+00:00"))
-
-        sensor_items = get_recent_sensor_data(trigger_time)
-
-        combined_message = generate_combined_recommendations(sensor_items)
-        if combined_message:
-            invoke_telegram_lambda(
-                action='send_message',
-                payload={"message": combined_message}
-            )
-            logger.info("Recommendations sent to Telegram.")
-        else:
-            logger.info("No recommendations to send.")
-
-        # Mark the event as processed
-        mark_event_as_processed(pk, sk)
+        try:
+            # Get trigger time from event bridge trigger
+            trigger_time_str = event['time']
+            trigger_time = datetime.fromisoformat(trigger_time_str.replace("Z", "+00:00"))
+
+            with phase('dynamodb'):
+                field_ids = list_fields(dynamodb)
+                try:
+                    sensor_health = load_sensor_health(dynamodb)
+                except Exception as e:
+                    # The health warnings are extra information, the recommendations are sent without them
+                    logger.error(f"Failed to load the sensor health: {str(e)}")
+                    sensor_health = {}
+
+            recommendations = generate_health_warnings(sensor_health, trigger_time)
+            if should_fan_out(field_ids):
+                recommendations.extend(analyze_fields(field_ids, trigger_time_str, context))
+            else:
+                with phase('dynamodb'):
+                    sensor_items = get_recent_sensor_data(trigger_time)
+                recommendations.extend(generate_recommendations(sensor_items))
+
+            combined_message = combine_recommendations(recommendations)
+            if combined_message:
+                with phase('notification'):
+                    enqueue_notification(
+                        action='send_message',
+                        payload={"message": combined_message},
+                        dedup_key=f"{pk}:{sk}",
+                        group_id=pk
+                    )
+                logger.info("Recommendations queued for Telegram.")
+            else:
+                logger.info("No recommendations to send.")
+        except Exception:
+            # Allow a retry of the event to process it again
+            release_event(pk, sk)
+            raise
+
+        with phase('idempotency'):
+            complete_event(pk, sk)
 
         return {
             "statusCode": 200,
@@ -1,44 +1,166 @@
 import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
 import requests
-from botocore.exceptions import BotoCoreError
+from botocore.exceptions import BotoCoreError, ClientError
+from requests.adapters import HTTPAdapter
+from idempotency import claim_event, complete_event, release_event
+from profiling import phase, profiled_handler
+from runtime import client, env, env_list, timed_handler
 
 # Config
-TELEGRAM_TOKEN = "7701970803:AAHMBH5xrO_bD7jPZxxqQcRlm8tlsGkkjEs"
-TELEGRAM_CHAT_ID = "-4731796983"
+TELEGRAM_TOKEN = env('TELEGRAM_TOKEN', "7701970803:AAHMBH5xrO_bD7jPZxxqQcRlm8tlsGkkjEs")
+TELEGRAM_CHAT_ID = env('TELEGRAM_CHAT_ID', "-4731796983")
+TELEGRAM_CHAT_IDS = env_list('TELEGRAM_CHAT_IDS', [TELEGRAM_CHAT_ID])  # All chats that receive messages and images
+
+MAX_RATE_LIMIT_RETRIES = env('MAX_RATE_LIMIT_RETRIES', 3, int)  # How often a request is retried after Telegram answered with 429
+MAX_RETRY_AFTER_SECONDS = env('MAX_RETRY_AFTER_SECONDS', 30, int)  # Never wait longer than this for a single 429 back-off
+MAX_PARALLEL_CHATS = env('MAX_PARALLEL_CHATS', 8, int)
+EVENT_IDEMPOTENCY_FUNCTION_NAME = env('EVENT_IDEMPOTENCY_FUNCTION_NAME', "TelegramCommunicationFunction")  # Partition key of the delivered dedup keys
+DOCUMENT_THRESHOLD_CHARS = env('DOCUMENT_THRESHOLD_CHARS', 3 * 4096, int)  # Longer messages are sent as one text file, 0 never does
+
+TELEGRAM_MESSAGE_LIMIT = 4096  # Characters per message accepted by the Bot API
+TELEGRAM_CAPTION_LIMIT = 1024
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
-TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
+TELEGRAM_API_URL = env('TELEGRAM_API_URL', f"https://api.telegram.org/bot{TELEGRAM_TOKEN}")
+
+# Clients are created once per container and reused across warm invocations, so the
+# TLS connection to api.telegram.org is kept alive between chunks, chats and invocations
+s3 = client('s3')
+
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_PARALLEL_CHATS))
+session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_PARALLEL_CHATS))
+
+
+def post_to_telegram(method, **kwargs):
+    """
+    Posts a request to the given Telegram API method over the shared session.
+    Waits and retries when Telegram rate limits the request with a 429 status.
+    """
+    url = f"{TELEGRAM_API_URL}/{method}"
+
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        response = session.post(url, **kwargs)
+        if response.status_code != 429 or attempt == MAX_RATE_LIMIT_RETRIES:
+            return response
+
+        try:
+            retry_after = response.json().get("parameters", {}).get("retry_after", 1)
+        except ValueError:
+            retry_after = 1
+
+        retry_after = min(retry_after, MAX_RETRY_AFTER_SECONDS)
+        logger.warning(f"Telegram rate limit hit on {method}, retrying in {retry_after}s")
+        time.sleep(retry_after)
+
+
+def send_to_all_chats(send_function, *args):
+    """
+    Runs the send function for every configured chat. Chats are served in parallel,
+    as Telegram rate limits are applied per chat. The 'telegram' phase is the wall time
+    of all chats together.
+    """
+    with phase("telegram"):
+        if len(TELEGRAM_CHAT_IDS) == 1:
+            send_function(TELEGRAM_CHAT_IDS[0], *args)
+            return
+
+        with ThreadPoolExecutor(max_workers=min(len(TELEGRAM_CHAT_IDS), MAX_PARALLEL_CHATS)) as executor:
+            futures = [executor.submit(send_function, chat_id, *args) for chat_id in TELEGRAM_CHAT_IDS]
+
+            # Re-raises the first error of any chat
+            for future in futures:
+                future.result()
+
+
+def telegram_length(text):
+    """
+    Returns the length of a text as counted by Telegram, in UTF-16 code units. Most emojis count twice.
+    """
+    return len(text.encode("utf-16-le")) // 2
+
+
+def split_long_line(line, limit):
+    """Splits a single line that does not fit into one message at the limit."""
+    pieces = []
+    piece = ""
+    for character in line:
+        if telegram_length(piece + character) > limit:
+            pieces.append(piece)
+            piece = ""
+        piece += character
+    if piece:
+        pieces.append(piece)
+    return pieces
+
+
+def pack_lines(message, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Packs the lines of a message into as few chunks as possible in one pass.
+    Lines are never split, unless a single line is longer than the limit.
+    """
+    chunks = []
+    lines = []
+    length = 0
+
+    for line in message.split("\n"):
+        line_length = telegram_length(line)
+        if length + 1 + line_length > limit and lines:
+            chunks.append("\n".join(lines).rstrip())
+            lines, length = [], 0
+
+        # No chunk starts with the blank line between two recommendations
+        if not lines and not line.strip():
+            continue
+
+        # The last piece of a long line stays open, so the following lines can join it
+        if line_length > limit:
+            pieces = split_long_line(line, limit)
+            chunks.extend(pieces[:-1])
+            lines, length = [pieces[-1]], telegram_length(pieces[-1])
+            continue
+
+        length += line_length + (1 if lines else 0)
+        lines.append(line)
+
+    if lines:
+        chunks.append("\n".join(lines).rstrip())
+    return chunks
 
 
 def send_telegram_message(message):
     """
-    Sends a message to the configured Telegram chat using the Telegram API.
-    Splits the message into smaller parts if it exceeds the maximum length.
+    Sends a message to all configured Telegram chats using the Telegram API.
+    The lines are packed into as few messages as possible, a message above the document
+    threshold is sent as one text file instead.
     """
-    url = f"{TELEGRAM_API_URL}/sendMessage"
-    max_length = 3500  # Safer limit for long messages
-    start = 0
+    if DOCUMENT_THRESHOLD_CHARS and telegram_length(message) > DOCUMENT_THRESHOLD_CHARS:
+        file_name = f"digest_{time.strftime('%Y-%m-%d_%H-%M-%S', time.gmtime())}.txt"
+        send_to_all_chats(send_telegram_document_to_chat, file_name, message.encode(), document_caption(message))
+        return
+
+    send_to_all_chats(send_telegram_message_to_chat, pack_lines(message))
 
-    while start < len(message):
-        # Find the end of the current chunk
-        end = min(start + max_length, len(message))
-        if end < len(message):
-            newline_index = message.rfind("\n", start, end)  # Try to break at a newline
-            if newline_index > start:
-                end = newline_index
 
-        chunk = message[start:end]
+def send_telegram_message_to_chat(chat_id, chunks):
+    """
+    Sends the chunks of a message to a single Telegram chat using the Telegram API.
+    Every chunk is sent once the previous one was accepted, so they arrive in order,
+    all over the same keep-alive connection.
+    """
+    for chunk in chunks:
         payload = {
-            "chat_id": TELEGRAM_CHAT_ID,
+            "chat_id": chat_id,
             "text": chunk,
         }
         try:
-            response = requests.post(url, json=payload)
+            response = post_to_telegram("sendMessage", json=payload)
             if response.status_code == 200:
                 logger.debug(f"Message chunk sent to Telegram: {chunk}")
             else:
@@ -46,63 +168,220 @@ def send_telegram_message(message):
         except requests.RequestException as e:
             raise RuntimeError(f"An error occurred while sending a message to Telegram: {str(e)}")
 
-        # Move to the next chunk
-        start = end
+
+def document_caption(message):
+    """
+    Returns the first lines of a message that fit into a caption, followed by the number of lines in the file.
+    """
+    line_count = sum(1 for line in message.split("\n") if line.strip())
+    note = f"\n\n({line_count} {'line' if line_count == 1 else 'lines'} in total, see the attached file)"
+    head = pack_lines(message, TELEGRAM_CAPTION_LIMIT - telegram_length(note))
+    return (head[0] if head else "") + note
+
+
+def send_telegram_document_to_chat(chat_id, file_name, content, caption=None):
+    """
+    Uploads an in-memory text file to a single Telegram chat using the Telegram API.
+    """
+    try:
+        files = {"document": (file_name, content, "text/plain")}
+        data = {"chat_id": chat_id, "caption": caption}
+        response = post_to_telegram("sendDocument", files=files, data=data)
+        if response.status_code != 200:
+            raise RuntimeError(f"Failed to send document to Telegram. Response: {response.text}")
+    except requests.RequestException as e:
+        raise RuntimeError(f"An error occurred while sending a document to Telegram: {str(e)}")
 
 
 def send_telegram_image(bucket_name, s3_key, caption=None):
     """
-    Downloads an image from S3 and sends it to Telegram using the Telegram API.
+    Streams an image from S3 and sends it to all configured Telegram chats using the Telegram API.
+    The image is kept in memory and never written to /tmp.
     """
-    s3 = boto3.client('s3')
-    download_path = f"/tmp/{s3_key.split('/')[-1]}"
     try:
-        # Download the file from S3
-        s3.download_file(bucket_name, s3_key, download_path)
-        logger.debug(f"Image downloaded from S3: {bucket_name}/{s3_key} to {download_path}")
-
-        url = f"{TELEGRAM_API_URL}/sendPhoto"
-        with open(download_path, 'rb') as image:
-            files = {"photo": image}
-            data = {"chat_id": TELEGRAM_CHAT_ID, "caption": caption}
-            response = requests.post(url, files=files, data=data)
-            if response.status_code == 200:
-                logger.debug(f"Image sent to Telegram: {bucket_name}/{s3_key}")
-            else:
-                raise RuntimeError(f"Failed to send image to Telegram. Response: {response.text}")
-    except BotoCoreError as e:
+        with phase("s3"):
+            response = s3.get_object(Bucket=bucket_name, Key=s3_key)
+            image = response['Body'].read()
+        logger.debug(f"Image fetched from S3: {bucket_name}/{s3_key} ({len(image)} bytes)")
+    except (BotoCoreError, ClientError) as e:
         raise RuntimeError(f"Failed to download image from S3: {str(e)}")
+
+    file_name = s3_key.split('/')[-1]
+    send_to_all_chats(send_telegram_image_to_chat, file_name, image, caption)
+    logger.debug(f"Image sent to Telegram: {bucket_name}/{s3_key}")
+
+
+def send_telegram_image_to_chat(chat_id, file_name, image, caption=None):
+    """
+    Uploads an in-memory image to a single Telegram chat using the Telegram API.
+    """
+    try:
+        files = {"photo": (file_name, image)}
+        data = {"chat_id": chat_id, "caption": caption}
+        response = post_to_telegram("sendPhoto", files=files, data=data)
+        if response.status_code != 200:
+            raise RuntimeError(f"Failed to send image to Telegram. Response: {response.text}")
     except requests.RequestException as e:
         raise RuntimeError(f"An error occurred while sending an image to Telegram: {str(e)}")
 
 
-def lambda_handler(event, context):
+def process_action(event):
     """
-    Lambda function entry point for sending Telegram messages or images.
+    Executes a single 'send_message' or 'send_image' action and returns its name.
     """
-    try:
-        logger.info(f"Received event: {json.dumps(event, indent=2)}")
+    action = event.get('action')
+
+    if action == 'send_message':
+        message = event.get('message')
+        if not message:
+            raise ValueError("'message' must be provided for 'send_message' action.")
+        send_telegram_message(message)
+
+    elif action == 'send_image':
+        bucket_name = event.get('bucket_name')
+        s3_key = event.get('s3_key')
+        caption = event.get('caption', None)
+
+        if not bucket_name or not s3_key:
+            raise ValueError("Both 'bucket_name' and 's3_key' must be provided for 'send_image' action.")
+
+        send_telegram_image(bucket_name, s3_key, caption)
+
+    else:
+        raise ValueError(f"Invalid action '{action}' specified. Use 'send_message' or 'send_image'.")
+
+    return action
+
+
+def complete_dedup_keys(dedup_keys):
+    """
+    Marks the dedup keys of delivered notifications as completed. The notifications were already sent,
+    so errors are only logged: the claims then expire with their lease.
+    """
+    for dedup_key in dedup_keys:
+        try:
+            complete_event(EVENT_IDEMPOTENCY_FUNCTION_NAME, dedup_key)
+        except Exception as e:
+            logger.error(f"Failed to complete dedup key {dedup_key}: {str(e)}")
+
+
+def release_dedup_keys(dedup_keys):
+    """
+    Releases the dedup keys of notifications that could not be delivered, so their retries are sent.
+    """
+    for dedup_key in dedup_keys:
+        release_event(EVENT_IDEMPOTENCY_FUNCTION_NAME, dedup_key)
+
+
+def process_queue_batch(records, context=None):
+    """
+    Processes a batch of notifications delivered by SQS.
+    All pending text messages are combined into a single send. Duplicates are dropped by their
+    'dedup_key', which is claimed in the idempotency table, so duplicates in later batches are
+    dropped too. Returns the message IDs of the records that could not be delivered, SQS retries
+    them and moves them to the dead-letter queue once maxReceiveCount is reached.
+    """
+    failed_ids = []
+    messages = []
+    message_ids = []
+    message_keys = []
+
+    for record in records:
+        try:
+            notification = json.loads(record['body'])
+        except ValueError as e:
+            # Malformed records can never succeed, so they are dropped instead of retried
+            logger.error(f"Dropping malformed notification {record['messageId']}: {str(e)}")
+            continue
+
+        dedup_key = notification.get('dedup_key')
+        if dedup_key is not None:
+            try:
+                claimed = claim_event(EVENT_IDEMPOTENCY_FUNCTION_NAME, dedup_key, context)
+            except Exception as e:
+                logger.error(f"Failed to claim notification {record['messageId']}: {str(e)}")
+                failed_ids.append(record['messageId'])
+                continue
+            if not claimed:
+                logger.info(f"Dropping duplicate notification with key {dedup_key}")
+                continue
+
+        if notification.get('action') == 'send_message' and notification.get('message'):
+            messages.append(notification['message'])
+            message_ids.append(record['messageId'])
+            if dedup_key is not None:
+                message_keys.append(dedup_key)
+            continue
+
+        try:
+            process_action(notification)
+            if dedup_key is not None:
+                complete_dedup_keys([dedup_key])
+        except ValueError as e:
+            logger.error(f"Dropping invalid notification {record['messageId']}: {str(e)}")
+        except Exception as e:
+            logger.error(f"Failed to deliver notification {record['messageId']}: {str(e)}")
+            failed_ids.append(record['messageId'])
+            if dedup_key is not None:
+                release_dedup_keys([dedup_key])
+
+    if messages:
+        try:
+            send_telegram_message("\n\n".join(messages))
+            logger.info(f"Sent {len(messages)} queued messages in one batch")
+            complete_dedup_keys(message_keys)
+        except Exception as e:
+            logger.error(f"Failed to deliver batch of {len(messages)} messages: {str(e)}")
+            failed_ids.extend(message_ids)
+            release_dedup_keys(message_keys)
+
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed_ids]}
 
-        action = event.get('action')
 
-        if action == 'send_message':
-            message = event.get('message')
-            if not message:
-                raise ValueError("'message' must be provided for 'send_message' action.")
-            send_telegram_message(message)
+def process_async_event(event, context=None):
+    """
+    Executes the action of an asynchronous invoke once per 'dedup_key'. Lambda may deliver an
+    asynchronous event more than once, so its key is claimed in the idempotency table first.
+    Returns the action, or None if the event was already delivered.
+    """
+    dedup_key = event.get('dedup_key')
+    if dedup_key is None:
+        return process_action(event)
+
+    if not claim_event(EVENT_IDEMPOTENCY_FUNCTION_NAME, dedup_key, context):
+        logger.info(f"Dropping duplicate notification with key {dedup_key}")
+        return None
+
+    try:
+        action = process_action(event)
+    except Exception:
+        release_dedup_keys([dedup_key])
+        raise
+
+    complete_dedup_keys([dedup_key])
+    return action
 
-        elif action == 'send_image':
-            bucket_name = event.get('bucket_name')
-            s3_key = event.get('s3_key')
-            caption = event.get('caption', None)
 
-            if not bucket_name or not s3_key:
-                raise ValueError("Both 'bucket_name' and 's3_key' must be provided for 'send_image' action.")
+@timed_handler
+@profiled_handler
+def lambda_handler(event, context):
+    """
+    Lambda function entry point for sending Telegram messages or images.
+    """
+    try:
+        logger.info(f"Received event: {json.dumps(event, indent=2)}")
 
-            send_telegram_image(bucket_name, s3_key, caption)
+        # Notifications delivered through the SQS queue
+        records = event.get('Records')
+        if records and records[0].get('eventSource') == 'aws:sqs':
+            return process_queue_batch(records, context)
 
+        # Asynchronous invocations are only retried and dead-lettered when the function fails,
+        # so every error is raised for them. Synchronous callers get an error response instead
+        if event.get('async'):
+            action = process_async_event(event, context)
         else:
-            raise ValueError("Invalid action '{action}' specified. Use 'send_message' or 'send_image'.")
+            action = process_action(event)
 
         return {
             "statusCode": 200,
@@ -113,7 +392,9 @@ def lambda_handler(event, context):
         }
 
     except ValueError as e:
-        logger.error({str(e)})
+        logger.error(str(e))
+        if event.get('async'):
+            raise
         return {
             "statusCode": 400,
             "body": json.dumps({
@@ -123,6 +404,8 @@ def lambda_handler(event, context):
         }
     except RuntimeError as e:
         logger.error(f"RuntimeError: {str(e)}")
+        if event.get('async'):
+            raise
         return {
             "statusCode": 502,
             "body": json.dumps({
@@ -131,6 +414,8 @@ def lambda_handler(event, context):
         }
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)}")
+        if event.get('async'):
+            raise
         return {
             "statusCode": 500,
             "body": json.dumps({
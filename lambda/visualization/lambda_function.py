@@ -5,39 +5,75 @@ import os
 # Set Matplotlib config directory to /tmp (must be set before importing Matplotlib)
 os.environ["MPLCONFIGDIR"] = "/tmp"
 
+import hashlib
 import json
-import boto3
+import math
+import multiprocessing
+import shutil
+import subprocess
+import tempfile
+import time
 
 from boto3.dynamodb.conditions import Key
-import geopandas as gpd
-from shapely.geometry import box
+import numpy as np
+from scipy.spatial import cKDTree
 import matplotlib.pyplot as plt
 from matplotlib.colors import Normalize
 from matplotlib.cm import ScalarMappable
 from io import BytesIO
+from PIL import Image
 import contextily as ctx
+from botocore.exceptions import ClientError
+from idempotency import claim_event, complete_event, release_event
+from partitioning import invoke_workers, list_field_sensors, list_fields, should_fan_out
+from profiling import phase, profiled_handler
+from runtime import client, env, resource, timed_handler
 
 # Initialize the DynamoDB client
-dynamodb = boto3.resource("dynamodb")
+dynamodb = resource("dynamodb")
 
 # Initialize S3 bucket
-s3 = boto3.client("s3")
+s3 = client("s3")
 
 # DynamoDB table
-table = dynamodb.Table("Sensordata")
+table = dynamodb.Table(env("SENSOR_DATA_TABLE", "Sensordata"))
 
 # S3 bucket name
-BUCKET_NAME = "heatmap-bucket-agrisense"
-DEFAULT_OUTPUT_PATH = "heatmaps/sensor_heatmap.png"
+BUCKET_NAME = env("BUCKET_NAME", "heatmap-bucket-agrisense")
+DEFAULT_OUTPUT_PATH = env("DEFAULT_OUTPUT_PATH", "heatmaps/sensor_heatmap.png")
+LATEST_HEATMAP_POINTER_KEY = env("LATEST_HEATMAP_POINTER_KEY", "heatmaps/latest.json")  # Lets the delivery Lambda find the latest heatmap without listing the bucket
+LOCAL_TIMEZONE = env("LOCAL_TIMEZONE", "Europe/Vienna")
 
-square_size_lat = 0.009
-square_size_lon = square_size_lat / 0.7
+RENDER_QUEUE_URL = env("RENDER_QUEUE_URL")  # SQS queue delaying the trailing render of a window
+# Triggers within the same window are coalesced into one render, 0 renders on every trigger.
+# Off by default without a render queue, as the last update of a burst would not be rendered
+COALESCE_WINDOW_SECONDS = env("COALESCE_WINDOW_SECONDS", 60 if RENDER_QUEUE_URL else 0, int)
+EVENT_IDEMPOTENCY_FUNCTION_NAME = env("EVENT_IDEMPOTENCY_FUNCTION_NAME", "VisualizationFunction")
+MAX_SQS_DELAY_SECONDS = 900
 
+# Fan-out per field
+WORKER_FUNCTION_NAME = env("WORKER_FUNCTION_NAME")  # Function fetching the readings of a single field, defaults to this function
 
-def fetch_data_from_dynamodb():
+# Interpolation of the sensor readings onto the heatmap raster
+GRID_RESOLUTION = env("GRID_RESOLUTION", 400, int)  # Raster pixels along the longer side of the sensor area
+IDW_NEIGHBORS = env("IDW_NEIGHBORS", 6, int)  # Nearest sensors used for every pixel, 1 gives a nearest-neighbor map
+IDW_POWER = env("IDW_POWER", 2, float)
+MAX_SENSOR_DISTANCE_LAT = env("MAX_SENSOR_DISTANCE_LAT", 0.009, float)  # Pixels farther from any sensor stay transparent
+LON_SCALE = 0.7  # Length of a degree longitude relative to a degree latitude in Austria
+
+# Time-lapse
+TIMELAPSE_OUTPUT_PATH = env("TIMELAPSE_OUTPUT_PATH", "timelapses/sensor_timelapse")
+TIMELAPSE_FORMATS = {"gif": "image/gif", "webp": "image/webp", "mp4": "video/mp4"}
+TIMELAPSE_MAX_WORKERS = env("TIMELAPSE_MAX_WORKERS", 2, int)  # Lambda gets one vCPU per 1769 MB of memory
+TIMELAPSE_FRAMES_PER_WORKER = env("TIMELAPSE_FRAMES_PER_WORKER", 24, int)  # Shorter time-lapses are rendered in-process
+
+# KD-tree and raster neighbor lookup of the last sensor set, reused by warm invocations
+interpolation_cache = {"key": None, "grid": None}
+
+
+def fetch_sensor_ids():
     """
-    Fetch latest records from the DynamoDB table.
-    Returns a list of records with sensor data.
+    Fetch the IDs of all sensors in the DynamoDB table.
     """
     response = table.scan(ProjectionExpression="sensor_id")
     sensor_ids = {item["sensor_id"] for item in response.get("Items", [])}
@@ -49,6 +85,14 @@ def fetch_data_from_dynamodb():
         )
         sensor_ids.update({item["sensor_id"] for item in response.get("Items", [])})
 
+    return sensor_ids
+
+
+def fetch_latest_records(sensor_ids):
+    """
+    Fetch the latest record of every given sensor.
+    Sensors in deadband mode only report changes, so the latest record is used regardless of its age.
+    """
     latest_data = []
     for sensor_id in sensor_ids:
         query_response = table.query(
@@ -61,39 +105,178 @@ def fetch_data_from_dynamodb():
     return latest_data
 
 
-def create_heatmap(data):
+def fetch_data_from_dynamodb():
     """
-    Create a heatmap based on DynamoDB data, save it to S3, and return the S3 key.
+    Fetch latest records from the DynamoDB table.
+    Returns a list of records with sensor data.
     """
-    latitudes = [item["location"]["lat"] for item in data]
-    longitudes = [item["location"]["lon"] for item in data]
-    temperatures = [item["measurements"]["temperature"] for item in data]
+    return fetch_latest_records(fetch_sensor_ids())
 
-    geometry = [
-        box(
-            float(lon) - square_size_lon / 2,
-            float(lat) - square_size_lat / 2,
-            float(lon) + square_size_lon / 2,
-            float(lat) + square_size_lat / 2,
-        )
-        for lon, lat in zip(longitudes, latitudes)
+
+def fetch_field_data(field_id):
+    """
+    Fetch the latest record of every sensor registered for a field, with the same semantics as the
+    in-process path. Sensors whose latest record belongs to another field are left to that field.
+    Returns the records reduced to the values the heatmap needs.
+    """
+    sensor_ids = list_field_sensors(client("dynamodb"), field_id)
+    latest = [item for item in fetch_latest_records(sensor_ids) if item.get("field_id") == field_id]
+
+    # Numbers are passed on as strings, so they keep their exact DynamoDB representation
+    return [
+        {
+            "sensor_id": item["sensor_id"],
+            "timestamp": int(item["timestamp"]),
+            "location": {"lat": str(item["location"]["lat"]), "lon": str(item["location"]["lon"])},
+            "measurements": {"temperature": str(item["measurements"]["temperature"])},
+        }
+        for item in latest
     ]
-    geo_df = gpd.GeoDataFrame(
-        {"geometry": geometry, "temperature": temperatures}, crs="EPSG:4326"
+
+
+def fetch_data(context):
+    """
+    Fetch the latest records of all sensors. Large fleets are fetched by one worker invocation per field
+    in parallel, whose records are merged into one heatmap.
+    """
+    with phase("dynamodb"):
+        field_ids = list_fields(client("dynamodb"))
+        if not should_fan_out(field_ids):
+            return fetch_data_from_dynamodb()
+
+    function_name = WORKER_FUNCTION_NAME or context.function_name
+    with phase("fan_out"):
+        results = invoke_workers(function_name, [{"mode": "field", "field_id": field_id} for field_id in field_ids])
+
+    data = []
+    for field_id, result in zip(field_ids, results):
+        # A heatmap with a missing field would look like the field has no sensors
+        if isinstance(result, Exception):
+            raise RuntimeError(f"Worker for field {field_id} failed: {result}")
+        data.extend(result["items"])
+    return data
+
+
+def build_interpolation_grid(longitudes, latitudes):
+    """
+    Builds a KD-tree over the sensor coordinates and looks up the nearest sensors of every raster pixel.
+    Returns the raster extent, the neighbor indices and the normalized inverse distance weights.
+    """
+    points = np.column_stack((longitudes * LON_SCALE, latitudes))
+    tree = cKDTree(points)
+
+    margin = MAX_SENSOR_DISTANCE_LAT / 2
+    lon_min, lon_max = longitudes.min() - margin / LON_SCALE, longitudes.max() + margin / LON_SCALE
+    lat_min, lat_max = latitudes.min() - margin, latitudes.max() + margin
+
+    # Square pixels in the scaled coordinate system
+    width, height = (lon_max - lon_min) * LON_SCALE, lat_max - lat_min
+    pixel_size = max(width, height) / GRID_RESOLUTION
+    columns, rows = max(int(width / pixel_size), 1), max(int(height / pixel_size), 1)
+
+    grid_lon, grid_lat = np.meshgrid(
+        np.linspace(lon_min, lon_max, columns),
+        np.linspace(lat_min, lat_max, rows),
     )
+    pixels = np.column_stack((grid_lon.ravel() * LON_SCALE, grid_lat.ravel()))
+
+    neighbors = min(IDW_NEIGHBORS, len(points))
+    distances, indices = tree.query(pixels, k=neighbors)
+    if neighbors == 1:
+        distances, indices = distances[:, None], indices[:, None]
+
+    weights = 1 / np.maximum(distances, 1e-12) ** IDW_POWER
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    mask = distances[:, 0] > MAX_SENSOR_DISTANCE_LAT
+    return {
+        "extent": (lon_min, lon_max, lat_min, lat_max),
+        "shape": (rows, columns),
+        "indices": indices,
+        "weights": weights,
+        "mask": mask,
+    }
+
+
+def get_interpolation_grid(longitudes, latitudes):
+    """
+    Returns the interpolation grid of the sensor set, building it only if the sensors changed.
+    """
+    key = hash((longitudes.tobytes(), latitudes.tobytes()))
+    if interpolation_cache["key"] != key:
+        interpolation_cache["grid"] = build_interpolation_grid(longitudes, latitudes)
+        interpolation_cache["key"] = key
+    return interpolation_cache["grid"]
+
+
+def interpolate_to_grid(longitudes, latitudes, values):
+    """
+    Interpolates the sensor values onto the heatmap raster with inverse distance weighting.
+    Returns the raster and its extent.
+    """
+    grid = get_interpolation_grid(longitudes, latitudes)
+
+    raster = (values[grid["indices"]] * grid["weights"]).sum(axis=1)
+    raster[grid["mask"]] = np.nan
+    return raster.reshape(grid["shape"]), grid["extent"]
+
+
+def compute_fingerprint(data):
+    """
+    Computes a fingerprint of the heatmap input: the sensors with the time and value of their latest reading.
+    """
+    digest = hashlib.sha256()
+    for item in sorted(data, key=lambda item: item["sensor_id"]):
+        digest.update(
+            f'{item["sensor_id"]}|{item["timestamp"]}|{item["location"]["lat"]}|{item["location"]["lon"]}|'
+            f'{item["measurements"]["temperature"]}\n'.encode()
+        )
+    return digest.hexdigest()
+
+
+def get_latest_heatmap_pointer():
+    """
+    Returns the latest heatmap pointer object, or None if no heatmap was published yet.
+    """
+    try:
+        response = s3.get_object(Bucket=BUCKET_NAME, Key=LATEST_HEATMAP_POINTER_KEY)
+        return json.loads(response["Body"].read())
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return None
+        raise
+
+
+def create_heatmap(data, fingerprint=None):
+    """
+    Create a heatmap based on DynamoDB data, save it to S3, and return the S3 key.
+    """
+    # Sort by sensor, so the same sensor set always maps to the same cached grid
+    data = sorted(data, key=lambda item: item["sensor_id"])
+    latitudes = np.array([float(item["location"]["lat"]) for item in data])
+    longitudes = np.array([float(item["location"]["lon"]) for item in data])
+    temperatures = np.array([float(item["measurements"]["temperature"]) for item in data])
+
+    with phase("interpolation"):
+        raster, extent = interpolate_to_grid(longitudes, latitudes, temperatures)
 
     cmap = plt.cm.viridis
-    norm = Normalize(vmin=min(temperatures), vmax=max(temperatures))
+    norm = Normalize(vmin=temperatures.min(), vmax=temperatures.max())
 
     fig, ax = plt.subplots(figsize=(12, 8))
-    geo_df.plot(
-        ax=ax,
-        color=[cmap(norm(float(temp))) for temp in temperatures],
+    ax.imshow(
+        raster,
+        extent=extent,
+        origin="lower",
+        cmap=cmap,
+        norm=norm,
         alpha=0.5,
-        edgecolor="black",
+        interpolation="nearest",
     )
+    ax.set_aspect(1 / LON_SCALE)
 
-    ctx.add_basemap(ax, crs="EPSG:4326", source=ctx.providers.Esri.WorldImagery)
+    with phase("basemap"):
+        ctx.add_basemap(ax, crs="EPSG:4326", source=ctx.providers.Esri.WorldImagery)
 
     sm = ScalarMappable(cmap=cmap, norm=norm)
     sm.set_array([])
@@ -101,7 +284,7 @@ def create_heatmap(data):
     cbar.set_label("Temperature (°C)")
 
     # Local time for the plot
-    local_timestamp = datetime.now(ZoneInfo("Europe/Vienna")).strftime("%A, %d %B %Y, %H:%M:%S %Z")
+    local_timestamp = datetime.now(ZoneInfo(LOCAL_TIMEZONE)).strftime("%A, %d %B %Y, %H:%M:%S %Z")
     ax.set_title(
         f"Satellite Heatmap (Generated: {local_timestamp})", fontsize=15
     )
@@ -113,31 +296,398 @@ def create_heatmap(data):
     dynamic_output_path = DEFAULT_OUTPUT_PATH.replace(".png", f"_{timestamp_utc}.png")
 
     buffer = BytesIO()
-    plt.savefig(buffer, format="png", bbox_inches="tight")
+    with phase("rendering"):
+        plt.savefig(buffer, format="png", bbox_inches="tight")
+    plt.close(fig)
     buffer.seek(0)
 
-    s3.upload_fileobj(buffer, BUCKET_NAME, dynamic_output_path)
-    buffer.close()
+    with phase("s3"):
+        s3.upload_fileobj(buffer, BUCKET_NAME, dynamic_output_path)
+        buffer.close()
+
+        update_latest_heatmap_pointer(dynamic_output_path, fingerprint)
+
     return dynamic_output_path
 
 
-def lambda_handler(event, context):
+def fetch_time_range_from_dynamodb(start_epoch, end_epoch):
     """
-    Lambda function to create a heatmap and store it in an S3 bucket.
+    Fetch all records between the two timestamps, plus the last record of every sensor before the start,
+    which is still current at the start of the range.
+    Returns a dict of record lists by sensor ID, sorted by time.
+    """
+    records = {}
+    for sensor_id in fetch_sensor_ids():
+        items = []
+        query_params = {
+            "KeyConditionExpression": Key("sensor_id").eq(sensor_id) & Key("timestamp").between(start_epoch, end_epoch),
+        }
+        while True:
+            response = table.query(**query_params)
+            items.extend(response.get("Items", []))
+            if "LastEvaluatedKey" not in response:
+                break
+            query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+        previous = table.query(
+            KeyConditionExpression=Key("sensor_id").eq(sensor_id) & Key("timestamp").lt(start_epoch),
+            ScanIndexForward=False,
+            Limit=1,
+        ).get("Items", [])
+
+        if previous or items:
+            records[sensor_id] = previous + items
+
+    return records
+
+
+def build_frame_values(records, frame_times):
+    """
+    Computes the temperature of every sensor at every frame time: the value of its latest record
+    at that time, or its first record for frames before it reported anything.
+    Returns the sensor coordinates and a frames x sensors array of temperatures.
+    """
+    sensor_ids = sorted(records)
+    longitudes = np.array([float(records[sensor_id][0]["location"]["lon"]) for sensor_id in sensor_ids])
+    latitudes = np.array([float(records[sensor_id][0]["location"]["lat"]) for sensor_id in sensor_ids])
+
+    values = np.empty((len(frame_times), len(sensor_ids)))
+    for column, sensor_id in enumerate(sensor_ids):
+        times = np.array([int(item["timestamp"]) for item in records[sensor_id]])
+        temperatures = np.array([float(item["measurements"]["temperature"]) for item in records[sensor_id]])
+
+        positions = np.searchsorted(times, frame_times, side="right") - 1
+        values[:, column] = temperatures[np.maximum(positions, 0)]
+
+    return longitudes, latitudes, values
+
+
+def render_timelapse_frames(longitudes, latitudes, values, frame_times, norm):
+    """
+    Renders the frames of a time-lapse. The basemap, axes and colorbar are drawn once,
+    every frame only redraws the heatmap layer and the time label on top of them.
+    Returns the frames as RGB arrays.
+    """
+    cmap = plt.cm.viridis
+    raster, extent = interpolate_to_grid(longitudes, latitudes, values[0])
+
+    fig, ax = plt.subplots(figsize=(12, 8))
+    image = ax.imshow(
+        raster,
+        extent=extent,
+        origin="lower",
+        cmap=cmap,
+        norm=norm,
+        alpha=0.5,
+        interpolation="nearest",
+        animated=True,
+    )
+    ax.set_aspect(1 / LON_SCALE)
+
+    ctx.add_basemap(ax, crs="EPSG:4326", source=ctx.providers.Esri.WorldImagery)
+
+    sm = ScalarMappable(cmap=cmap, norm=norm)
+    sm.set_array([])
+    cbar = fig.colorbar(sm, ax=ax, orientation="vertical", fraction=0.02, pad=0.04)
+    cbar.set_label("Temperature (°C)")
+
+    ax.set_title("Satellite Heatmap Time-Lapse", fontsize=15)
+    ax.set_xlabel("Longitude")
+    ax.set_ylabel("Latitude")
+    time_label = ax.text(
+        0.02, 0.97, "", transform=ax.transAxes, fontsize=13, va="top", animated=True,
+        bbox={"facecolor": "white", "alpha": 0.8, "edgecolor": "none"},
+    )
+
+    # Draw the static layers once and keep them as background
+    canvas = fig.canvas
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+
+    frames = []
+    for frame_time, frame_values in zip(frame_times, values):
+        raster, _ = interpolate_to_grid(longitudes, latitudes, frame_values)
+        local_time = datetime.fromtimestamp(int(frame_time), ZoneInfo(LOCAL_TIMEZONE))
+
+        canvas.restore_region(background)
+        image.set_data(raster)
+        time_label.set_text(local_time.strftime("%a, %d %b %Y, %H:%M %Z"))
+        ax.draw_artist(image)
+        ax.draw_artist(time_label)
+
+        frames.append(np.asarray(canvas.buffer_rgba())[:, :, :3].copy())
+
+    plt.close(fig)
+    return frames
+
+
+def render_timelapse_worker(connection, longitudes, latitudes, values, frame_times, norm):
+    """
+    Renders a part of the time-lapse in a child process and sends the frames back through the pipe.
     """
     try:
-        data = fetch_data_from_dynamodb()
-        dynamic_output_path = create_heatmap(data)
+        connection.send(render_timelapse_frames(longitudes, latitudes, values, frame_times, norm))
+    except Exception as e:
+        connection.send(e)
+    finally:
+        connection.close()
+
+
+def render_timelapse(longitudes, latitudes, values, frame_times, norm):
+    """
+    Renders all frames of a time-lapse. Long time-lapses are split into consecutive parts
+    rendered by child processes. Lambda has no shared memory for multiprocessing pools,
+    so every part gets its own process and pipe.
+    """
+    workers = min(TIMELAPSE_MAX_WORKERS, -(-len(frame_times) // TIMELAPSE_FRAMES_PER_WORKER))
+    if workers <= 1:
+        return render_timelapse_frames(longitudes, latitudes, values, frame_times, norm)
+
+    context = multiprocessing.get_context("fork")
+    parts = []
+    for part_times, part_values in zip(np.array_split(frame_times, workers), np.array_split(values, workers)):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(
+            target=render_timelapse_worker,
+            args=(sender, longitudes, latitudes, part_values, part_times, norm),
+        )
+        process.start()
+        sender.close()
+        parts.append((process, receiver))
+
+    frames = []
+    for process, receiver in parts:
+        result = receiver.recv()
+        process.join()
+        if isinstance(result, Exception):
+            raise result
+        frames.extend(result)
+
+    return frames
+
+
+def encode_timelapse(frames, output_format, fps):
+    """
+    Encodes the frames as animated GIF, animated WebP or MP4 video and returns the file content.
+    """
+    if output_format == "mp4":
+        ffmpeg = shutil.which("ffmpeg")
+        if ffmpeg is None:
+            raise ValueError("MP4 time-lapses require ffmpeg in the image")
+
+        height, width = frames[0].shape[:2]
+        with tempfile.NamedTemporaryFile(suffix=".mp4", dir="/tmp") as output:
+            subprocess.run(
+                [
+                    ffmpeg, "-y", "-loglevel", "error",
+                    "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+                    "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p", output.name,
+                ],
+                input=b"".join(frame.tobytes() for frame in frames),
+                check=True,
+            )
+            return output.read()
+
+    images = [Image.fromarray(frame) for frame in frames]
+    buffer = BytesIO()
+    images[0].save(
+        buffer,
+        format=output_format.upper(),
+        save_all=True,
+        append_images=images[1:],
+        duration=int(1000 / fps),
+        loop=0,
+    )
+    return buffer.getvalue()
+
+
+def create_timelapse(hours, step_minutes, output_format, fps):
+    """
+    Create a time-lapse of the heatmap over the last hours, save it to S3, and return the S3 key.
+    """
+    if output_format not in TIMELAPSE_FORMATS:
+        raise ValueError(f"Unknown time-lapse format {output_format}, use one of {', '.join(TIMELAPSE_FORMATS)}")
+
+    end_epoch = int(datetime.now(timezone.utc).timestamp())
+    start_epoch = end_epoch - int(hours * 3600)
+    frame_times = np.arange(start_epoch, end_epoch + 1, int(step_minutes * 60))
+
+    with phase("dynamodb"):
+        records = fetch_time_range_from_dynamodb(start_epoch, end_epoch)
+    if not records:
+        raise ValueError("No sensor data available for the time-lapse")
+
+    longitudes, latitudes, values = build_frame_values(records, frame_times)
+
+    # One color scale for all frames
+    norm = Normalize(vmin=values.min(), vmax=values.max())
 
+    # Build the interpolation grid before forking, so the worker processes inherit it
+    get_interpolation_grid(longitudes, latitudes)
+
+    with phase("rendering"):
+        frames = render_timelapse(longitudes, latitudes, values, frame_times, norm)
+    with phase("encoding"):
+        content = encode_timelapse(frames, output_format, fps)
+
+    timestamp_utc = datetime.now(timezone.utc).strftime("%Y-%m-%d_%H-%M-%S")
+    output_path = f"{TIMELAPSE_OUTPUT_PATH}_{timestamp_utc}.{output_format}"
+
+    with phase("s3"):
+        s3.put_object(
+            Bucket=BUCKET_NAME,
+            Key=output_path,
+            Body=content,
+            ContentType=TIMELAPSE_FORMATS[output_format],
+        )
+
+    return output_path
+
+
+def update_latest_heatmap_pointer(key, fingerprint=None):
+    """
+    Points the latest heatmap pointer object to the given heatmap key.
+    The fingerprint of the input data lets later invocations skip unchanged heatmaps.
+    """
+    pointer = {
+        "key": key,
+        "last_modified": datetime.now(timezone.utc).isoformat(),
+        "fingerprint": fingerprint,
+    }
+    s3.put_object(
+        Bucket=BUCKET_NAME,
+        Key=LATEST_HEATMAP_POINTER_KEY,
+        Body=json.dumps(pointer),
+        ContentType="application/json",
+    )
+
+
+def render_latest_heatmap(context):
+    """
+    Renders the heatmap of the latest readings, unless no reading changed since the last heatmap.
+    """
+    data = fetch_data(context)
+
+    # Skip rendering, upload and delivery if no reading changed since the last heatmap
+    fingerprint = compute_fingerprint(data)
+    with phase("s3"):
+        pointer = get_latest_heatmap_pointer()
+    if pointer is not None and pointer.get("fingerprint") == fingerprint:
         return {
             "statusCode": 200,
             "body": json.dumps(
                 {
-                    "message": "Plot created and uploaded to S3",
-                    "s3_path": dynamic_output_path,
+                    "message": "Sensor data unchanged, heatmap not rendered",
+                    "s3_path": pointer["key"],
                 }
             ),
         }
+
+    dynamic_output_path = create_heatmap(data, fingerprint)
+    return {
+        "statusCode": 200,
+        "body": json.dumps(
+            {
+                "message": "Plot created and uploaded to S3",
+                "s3_path": dynamic_output_path,
+            }
+        ),
+    }
+
+
+def schedule_trailing_render(window, context):
+    """
+    Makes sure the heatmap is rendered again at the end of a window whose first trigger already rendered,
+    so readings that arrived after that render are shown even if no later trigger follows.
+    The first coalesced trigger of the window claims its trailing render, the others are dropped.
+    Without a render queue all coalesced triggers are dropped, waiting for the end of the window
+    would keep a billed invocation idle.
+    """
+    if not RENDER_QUEUE_URL:
+        return {
+            "statusCode": 200,
+            "body": json.dumps({"message": "Coalesced, no render queue for a trailing render"}),
+        }
+
+    pk, sk = EVENT_IDEMPOTENCY_FUNCTION_NAME, f"window-{window}-trailing"
+    if not claim_event(pk, sk, context):
+        return {
+            "statusCode": 200,
+            "body": json.dumps({"message": "Coalesced with the trailing render of this window"}),
+        }
+
+    delay = max((window + 1) * COALESCE_WINDOW_SECONDS - time.time(), 0)
+    try:
+        client("sqs").send_message(
+            QueueUrl=RENDER_QUEUE_URL,
+            MessageBody=json.dumps({"window": window}),
+            DelaySeconds=min(math.ceil(delay), MAX_SQS_DELAY_SECONDS),
+        )
+    except Exception:
+        release_event(pk, sk)
+        raise
+
+    complete_event(pk, sk)
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"message": f"Trailing render scheduled in {math.ceil(delay)}s"}),
+    }
+
+
+@timed_handler
+@profiled_handler
+def lambda_handler(event, context):
+    """
+    Lambda function to create a heatmap and store it in an S3 bucket.
+    Creates a time-lapse of the last hours instead if the event sets "mode" to "timelapse".
+    """
+    # Worker invocations fail as a whole, so the coordinator sees the error
+    if event.get("mode") == "field":
+        with phase("dynamodb"):
+            return {"field_id": event["field_id"], "items": fetch_field_data(event["field_id"])}
+
+    # Trailing renders from the render queue fail as a whole, so SQS retries them
+    records = event.get("Records")
+    if records and records[0].get("eventSource") == "aws:sqs":
+        return render_latest_heatmap(context)
+
+    try:
+        if event.get("mode") == "timelapse":
+            output_path = create_timelapse(
+                hours=float(event.get("hours", 24)),
+                step_minutes=float(event.get("step_minutes", 60)),
+                output_format=event.get("format", "gif"),
+                fps=float(event.get("fps", 4)),
+            )
+            return {
+                "statusCode": 200,
+                "body": json.dumps(
+                    {
+                        "message": "Time-lapse created and uploaded to S3",
+                        "s3_path": output_path,
+                    }
+                ),
+            }
+
+        # The first trigger of a coalescing window renders right away, the later ones schedule
+        # one trailing render at the end of the window
+        if COALESCE_WINDOW_SECONDS > 0:
+            window = int(time.time()) // COALESCE_WINDOW_SECONDS
+            pk, sk = EVENT_IDEMPOTENCY_FUNCTION_NAME, f"window-{window}"
+            if not claim_event(pk, sk, context):
+                return schedule_trailing_render(window, context)
+
+        try:
+            response = render_latest_heatmap(context)
+        except Exception:
+            # Allow another trigger in this window to render
+            if COALESCE_WINDOW_SECONDS > 0:
+                release_event(pk, sk)
+            raise
+
+        if COALESCE_WINDOW_SECONDS > 0:
+            complete_event(pk, sk)
+        return response
     except Exception as e:
         return {
             "statusCode": 500,
@@ -0,0 +1,90 @@
+import heapq
+import math
+import random
+
+PATTERNS = ['uniform', 'diurnal', 'burst']
+
+SECONDS_PER_DAY = 24 * 60 * 60
+MIN_RATE_FACTOR = 0.01  # A diurnal amplitude of 1 or more would stop the sensors at night, they slow down to 1% instead
+MIN_INTERVAL_SECONDS = 0.001  # Keeps a sensor from being due again at the same time, e.g. with a jitter of 100%
+
+
+class ArrivalPattern:
+    """
+    Scales the sample rate of all sensors over time.
+    """
+
+    def __init__(self, name= 'uniform', diurnal_amplitude= 0.8, burst_period= 3600, burst_duration= 60, burst_factor= 10):
+        if name not in PATTERNS:
+            raise ValueError(f'Unknown arrival pattern {name}')
+
+        self.name = name
+        self.diurnal_amplitude = diurnal_amplitude
+        self.burst_period = burst_period
+        self.burst_duration = burst_duration
+        self.burst_factor = burst_factor
+
+    def rate_factor(self, elapsed, time_of_day):
+        if self.name == 'diurnal':
+            # Peaks at noon and is lowest at midnight
+            factor = 1 + self.diurnal_amplitude * math.sin(2 * math.pi * (time_of_day / SECONDS_PER_DAY - 0.25))
+            return max(factor, MIN_RATE_FACTOR)
+
+        if self.name == 'burst':
+            return self.burst_factor if elapsed % self.burst_period < self.burst_duration else 1
+
+        return 1
+
+
+class SensorScheduler:
+    """
+    Decides which sensor sends next. Keeps the next due time of every sensor in a heap,
+    so picking the next sensor takes O(log n) for n sensors.
+    Times are seconds since the start of the simulation.
+    """
+
+    def __init__(self, sensors, default_rate, rates_per_type= None, jitter= 0.0, pattern= None, start_time_of_day= 0):
+        self.sensors = sensors
+        self.default_rate = default_rate
+        self.rates_per_type = rates_per_type or {}
+        self.jitter = jitter
+        self.pattern = pattern or ArrivalPattern()
+        self.start_time_of_day = start_time_of_day
+
+        # Start every sensor at a random point of its first interval, so they do not send in lock-step
+        self.heap = [
+            (random.uniform(0, self.base_interval(sensor)), index)
+            for index, sensor in enumerate(sensors)
+        ]
+        heapq.heapify(self.heap)
+
+    def sample_rate(self, sensor):
+        """Samples per second of the sensor: its own rate, the rate of its type or the default rate."""
+        rate = getattr(sensor, 'sample_rate', None)
+        if rate is None:
+            rate = self.rates_per_type.get(sensor.sensor_type, self.default_rate)
+        return rate
+
+    def base_interval(self, sensor):
+        return 1 / self.sample_rate(sensor)
+
+    def next_interval(self, sensor, due_time):
+        time_of_day = (self.start_time_of_day + due_time) % SECONDS_PER_DAY
+        interval = self.base_interval(sensor) / self.pattern.rate_factor(due_time, time_of_day)
+
+        if self.jitter:
+            interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(interval, MIN_INTERVAL_SECONDS)
+
+    def peek_time(self):
+        return self.heap[0][0]
+
+    def pop(self):
+        """
+        Returns the due time and the sensor that sends next, and schedules its following sample.
+        """
+        due_time, index = self.heap[0]
+        sensor = self.sensors[index]
+
+        heapq.heapreplace(self.heap, (due_time + self.next_interval(sensor, due_time), index))
+        return due_time, sensor
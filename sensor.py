@@ -6,6 +6,61 @@ SENSOR_TYPES= [
   'IoT-2000', 'sensormatic', 'MQTT-Master'
 ]
 
+DEADBAND_PARAMETERS= [ 'humidity', 'temperature' ]
+
+
+class Deadband:
+  """
+  Report-by-exception: A reading is only published if a parameter changed by more than its
+  threshold since the last published reading, or if the heartbeat interval has passed.
+  """
+  def __init__(self, thresholds, heartbeat_interval):
+    self.thresholds= thresholds
+    self.heartbeat_interval= heartbeat_interval
+
+    # Statistics: distinct data rows sampled, and why samples were published or not
+    self.row_count= 0
+    self.change_count= 0
+    self.heartbeat_count= 0
+    self.suppressed_count= 0
+    self.last_rows= {}  # Data row of the last sample per sensor
+
+  def should_publish( self, sensor, now, values, row= None ):
+    """
+    Returns True if the sample is published. The row is the data row the sample was taken from, the
+    scheduler samples a row several times. Without a row, every sample counts as a row of its own.
+    """
+    if row is None or self.last_rows.get(sensor.sensor_id) != row:
+      self.row_count+= 1
+      self.last_rows[sensor.sensor_id]= row
+
+    last= sensor.last_published
+    if last is None or self.changed( last, values ):
+      self.change_count+= 1
+      return True
+
+    if now - last['time'] >= self.heartbeat_interval:
+      self.heartbeat_count+= 1
+      return True
+
+    self.suppressed_count+= 1
+    return False
+
+  def changed( self, last, values ):
+    return any( abs( values[parameter] - last[parameter] ) > threshold for parameter, threshold in self.thresholds.items() )
+
+  def summary( self ):
+    """
+    Compares the readings sent on a change with one reading per sensor and data row, so the
+    reduction does not count the repeated samples of a row. Heartbeats are reported separately.
+    """
+    reduction= 100 * (1 - self.change_count / max(self.row_count, 1))
+    return (
+      f"Deadband: {self.change_count} readings sent on a change for {self.row_count} sensor rows "
+      f"({round(reduction, 1)}% fewer than one reading per sensor and row), "
+      f"{self.heartbeat_count} sent on the heartbeat only, {self.suppressed_count} samples suppressed"
+    )
+
 class Sensor:
   def __init__(self, json_object, id_prefix= ''):
     self.longitude= json_object['geometry']['coordinates'][0]
@@ -17,6 +72,9 @@ class Sensor:
     self.sensor_id= id_prefix + self.create_unique_id()
     self.sensor_type= self.select_random_sensor_type()
 
+    # Time and values of the last published reading, used by the deadband mode
+    self.last_published= None
+
   def select_random_sensor_type( self ):
     return random.choice( SENSOR_TYPES )
   
@@ -28,11 +86,18 @@ class Sensor:
     hex_number= hex( hash_number )[3:]
     return f'sensor_{hex_number}'
 
-  def get_data_by_index( self, timestamp, index ):
+  def get_values_by_index( self, index ):
     humidity= self.humidity_data[index] if index < len(self.humidity_data) else -1
     temperature= self.temperature_data[index] if index < len(self.temperature_data) else -1
 
-    return self.format_data( timestamp, humidity, temperature )
+    return { 'humidity': humidity, 'temperature': temperature }
+
+  def get_data_by_index( self, timestamp, index ):
+    values= self.get_values_by_index( index )
+    return self.format_data( timestamp, values['humidity'], values['temperature'] )
+
+  def mark_published( self, now, values ):
+    self.last_published= { 'time': now, **values }
   
   def format_data( self, timestamp, humidity, temperature ):
     if self.sensor_type == 'IoT-2000':
@@ -1,13 +1,18 @@
 import time
-import iot_core as ic
-from sensor import create_sensors_from_data_file
+
+# Also makes the payload codec of the ingest Lambda importable
+from sinks import SINKS, FileSink, LambdaSink, MqttSink, NullSink, read_recording, recording_encoding
+from payload_codec import ENCODINGS
+from scheduler import PATTERNS, ArrivalPattern, SensorScheduler
+from sensor import DEADBAND_PARAMETERS, Deadband, create_sensors_from_data_file
 from argparse import ArgumentParser
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
 # MQTT Broker Configuration
 BROKER = "a86hzqaw9f6v0-ats.iot.eu-north-1.amazonaws.com"  # Replace with your MQTT broker address
 PORT = 8883  # Replace with your MQTT broker port (default is 1883)
-TOPIC = "sdk/test/python"  # Replace with your desired topic
+TOPIC = "sdk/test/python"  # Replace with your desired topic, JSON messages are parsed by the IoT rule on this topic
+BINARY_TOPIC = "sdk/test/binary"  # msgpack and cbor messages need their own rule, which passes them base64 encoded
 ROOT_CERT_FILE = "./AmazonRootCA1.pem"  # Root certificate authority, comes from AWS with a long, long name
 CERT_FILE = "./certs/Simulator.cert.pem"
 KEY_FILE = "./certs/Simulator.private.key"
@@ -15,7 +20,14 @@ CLIENT_ID = "basicPubSub"
 
 # Sensor Data Configuration
 SENSOR_ID_PREFIX = ""
-SAMPLE_RATE_PER_SENSOR = 1 / 120  # Number of samples per second per sensor
+# Samples per second of simulated time per sensor. Every data row is valid for one row interval (an hour) of
+# simulated time, so in real time each sensor sends 30 readings per row and the 72 hours of data take 72 hours.
+# --speed compresses the time, --legacy-pacing restores the former pacing of one reading per sensor and row
+SAMPLE_RATE_PER_SENSOR = 1 / 120
+SAMPLE_RATES_PER_SENSOR_TYPE = {  # Overrides the sample rate for all sensors of a type
+    # 'MQTT-Master': 1 / 300,
+}
+HEARTBEAT_INTERVAL = 15 * 60  # Seconds after which a reading is sent in deadband mode, even if nothing changed
 
 
 def configure():
@@ -24,9 +36,37 @@ def configure():
     parser.add_argument('-s', '--silent', action='store_true', help= 'Do not print messages while sending')
     parser.add_argument('-t', '--time', type=str, default=None, help= 'Sets the time of the first sample. Can be set to "now"')
     parser.add_argument('-b', '--batches', type=int, default=None, help= 'Number of batches to send. Each batch sends one message per sensor. Overrides count')
+    parser.add_argument('-e', '--encoding', choices=ENCODINGS, default='json', help= 'Payload encoding. msgpack and cbor use short keys')
+    parser.add_argument('--broker', type=str, default=None, help= 'host:port of a local MQTT broker without TLS, used by the mqtt sink instead of IoT Core')
+    parser.add_argument('--topic', type=str, default=None, help= f'MQTT topic. Defaults to {TOPIC} for json and {BINARY_TOPIC} for the binary encodings')
+    parser.add_argument('-f', '--frame-size', type=int, default=1, help= 'Number of readings sent together in one MQTT message')
+    parser.add_argument('-v', '--virtual-clock', action='store_true', help= 'Do not wait between messages, replay the data as fast as possible')
+    parser.add_argument('--speed', type=float, default=1, help= 'Simulated seconds per real second')
+    parser.add_argument('--legacy-pacing', action='store_true', help= 'Every sensor sends one reading per data row and a row takes 1 / SAMPLE_RATE_PER_SENSOR seconds, like before the scheduler (72 rows in 2.4 hours)')
+    parser.add_argument('-j', '--jitter', type=float, default=0, help= 'Random variation of the sample interval, e.g. 0.1 for +-10%%')
+    parser.add_argument('-p', '--pattern', choices=PATTERNS, default='uniform', help= 'Arrival pattern of the messages over time')
+    parser.add_argument('-d', '--deadband', type=parse_parameters, default=None, help= 'Only send readings that changed by more than a threshold, e.g. "humidity=1,temperature=0.2"')
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT_INTERVAL, help= 'Seconds after which a reading is sent in deadband mode, even if nothing changed')
+    parser.add_argument('-o', '--sink', choices=SINKS, default='mqtt', help= 'Where to send the messages: IoT Core, a recording file, the ingest Lambda in-process or nowhere')
+    parser.add_argument('--output', type=str, default=None, help= 'Recording file of the file sink. Defaults to recording.ndjson or recording.bin, depending on the encoding')
+    parser.add_argument('-r', '--replay', type=str, default=None, help= 'Send the messages of a recording as fast as possible instead of simulating sensors. The encoding is taken from the recording')
+    parser.add_argument('-u', '--upscale', type=float, default=None, help= 'Multiply the number of sensors by interpolating between the grid points. Every sensor sends one reading per step')
+    parser.add_argument('--step', type=float, default=60, help= 'Seconds between the interpolated samples in upscale mode')
+    parser.add_argument('--noise', type=parse_parameters, default=None, help= 'Standard deviation of the noise in upscale mode, e.g. "humidity=0.5,temperature=0.1"')
+    parser.add_argument('--seed', type=int, default=None, help= 'Seed of the virtual sensor positions and the noise in upscale mode')
 
     return parser.parse_args()
 
+def parse_parameters( value ):
+    thresholds= {}
+    for part in value.split(','):
+        parameter, _, threshold= part.partition('=')
+        if parameter not in DEADBAND_PARAMETERS:
+            raise ValueError(f'Unknown parameter {parameter}')
+        thresholds[parameter]= float(threshold)
+
+    return thresholds
+
 def offset_timestamps( timestamps, offset_date ):
     # Nothing to offset
     if offset_date is None or len(timestamps) == 0:
@@ -49,41 +89,159 @@ def offset_timestamps( timestamps, offset_date ):
     # Add the offset to all timestamps and convert them back into ISO strings
     return [ (ts+ offset).isoformat() for ts in timestamps ]
 
-def send_loop(timestamps, sensors, count, silent):
+def send_loop(timestamps, sensors, count, silent, sink, frame_size= 1, scheduler= None, virtual_clock= False, speed= 1, deadband= None):
     start_time = time.time()
 
-    index = -1
+    # Each data row is valid for one interval of simulated time
+    first_timestamp = datetime.fromisoformat(timestamps[0])
+    row_interval = (datetime.fromisoformat(timestamps[1]) - first_timestamp).total_seconds() if len(timestamps) > 1 else 3600
+    duration = row_interval * len(timestamps)
+
+    if scheduler is None:
+        scheduler = SensorScheduler(sensors, SAMPLE_RATE_PER_SENSOR, SAMPLE_RATES_PER_SENSOR_TYPE)
+
     msg_id = -1
-    for timestamp in timestamps:
-        index += 1
+    frame = []
+    while scheduler.peek_time() < duration:
+        due_time, sensor = scheduler.pop()
+        index = int(due_time // row_interval)
 
-        for sensor in sensors:
-            msg_id += 1
+        # Skip readings that did not change enough since the last published one
+        values = sensor.get_values_by_index(index)
+        if deadband is not None:
+            if not deadband.should_publish(sensor, due_time, values, index):
+                continue
+            sensor.mark_published(due_time, values)
 
-            if msg_id + 1 > count:
-                print(f"Done sending {count} messages")
+        msg_id += 1
 
-                end_time = time.time()
-                return msg_id, end_time - start_time
+        if msg_id + 1 > count:
+            flush_frame(frame, sink)
+            print(f"Done sending {count} messages")
 
-            payload = sensor.get_data_by_index(timestamp, index)
-            if not silent:
-                print(
-                    f"Publishing message {msg_id} (row {index}) to topic '{TOPIC}': {payload}"
-                )
+            end_time = time.time()
+            return msg_id, end_time - start_time
 
-            ic.publish_to_iot_core(TOPIC, payload)
+        # Maintain the sample rate
+        if not virtual_clock:
+            wait_time = start_time + due_time / speed - time.time()
+            if wait_time > 0:
+                flush_frame(frame, sink)
+                time.sleep(wait_time)
 
-            wait_time = 1 / (SAMPLE_RATE_PER_SENSOR * len(sensors))
-            time.sleep(wait_time)  # Maintain the sample rate
+        timestamp = (first_timestamp + timedelta(seconds=due_time)).isoformat()
+
+        payload = sensor.format_data(timestamp, values['humidity'], values['temperature'])
+        if not silent:
+            print(
+                f"Publishing message {msg_id} (row {index}): {payload}"
+            )
+
+        frame.append(payload)
+        if len(frame) >= frame_size:
+            flush_frame(frame, sink)
+
+    flush_frame(frame, sink)
 
     end_time = time.time()
     return msg_id + 1, end_time - start_time
 
 
+def upscaled_send_loop(dataset, count, silent, sink, frame_size= 1, virtual_clock= False, speed= 1, deadband= None):
+    """Sends the samples of an upscaled dataset. All sensors send at the start of every step."""
+    start_time = time.time()
+    msg_id = 0
+    frame = []
+
+    for due_time, timestamp, sensor, values in dataset.samples():
+        if msg_id >= count:
+            print(f"Done sending {count} messages")
+            break
+
+        if deadband is not None:
+            # Every step is a sample of its own
+            if not deadband.should_publish(sensor, due_time, values):
+                continue
+            sensor.mark_published(due_time, values)
+
+        if not virtual_clock:
+            wait_time = start_time + due_time / speed - time.time()
+            if wait_time > 0:
+                flush_frame(frame, sink)
+                time.sleep(wait_time)
+
+        payload = sensor.format_data(timestamp, values['humidity'], values['temperature'])
+        if not silent:
+            print(f"Publishing message {msg_id}: {payload}")
+
+        frame.append(payload)
+        if len(frame) >= frame_size:
+            flush_frame(frame, sink)
+        msg_id += 1
+
+    flush_frame(frame, sink)
+    return msg_id, time.time() - start_time
+
+
+def flush_frame(frame, sink):
+    """Publishes the pending readings as one message and empties the frame."""
+    if not frame:
+        return
+
+    sink.send_readings(frame)
+    frame.clear()
+
+
+def topic_for(encoding):
+    """The IoT rule on the JSON topic cannot parse binary payloads, so they are sent to their own topic."""
+    return TOPIC if encoding == 'json' else BINARY_TOPIC
+
+
+def create_sink(config):
+    if config.sink == 'mqtt':
+        topic = config.topic or topic_for(config.encoding)
+        if config.broker:
+            host, port = config.broker.split(':')
+            return MqttSink(config.encoding, topic, host, int(port), None, None, None, CLIENT_ID, local=True)
+        return MqttSink(config.encoding, topic, BROKER, PORT, ROOT_CERT_FILE, CERT_FILE, KEY_FILE, CLIENT_ID)
+    if config.sink == 'file':
+        path = config.output or ('recording.ndjson' if config.encoding == 'json' else 'recording.bin')
+        return FileSink(config.encoding, path)
+    if config.sink == 'lambda':
+        return LambdaSink(config.encoding)
+    return NullSink(config.encoding)
+
+
+def replay(path, sink, count):
+    """Sends the messages of a recording in order, without waiting between them."""
+    start_time = time.time()
+    message_count = 0
+    for payload in read_recording(path):
+        if message_count >= count:
+            break
+        sink.send_payload(payload)
+        message_count += 1
+
+    return message_count, time.time() - start_time
+
+
 def main():
     config = configure()
 
+    # Replayed messages keep their encoding, which also picks the topic and the recording format of the sink
+    if config.replay is not None:
+        config.encoding = recording_encoding(config.replay)
+
+    sink = create_sink(config)
+
+    if config.replay is not None:
+        sink.open()
+        message_count, runtime = replay(config.replay, sink, config.count)
+        sink.close()
+
+        print(f"Replayed {message_count} messages in {round(runtime, 2)}s ({round(message_count / max(runtime, 1e-9))} msg/s): {sink.summary()}")
+        return
+
     timestamps, sensors = create_sensors_from_data_file(
         "./data/INCA analysis - large domain Datensatz_20250101T0000_20250103T2300.json",
         SENSOR_ID_PREFIX,
@@ -91,20 +249,59 @@ def main():
 
     timestamps= offset_timestamps(timestamps, config.time)
 
+    dataset = None
+    if config.upscale is not None:
+        # Requires numpy, which the other modes do not need
+        from upscaling import UpscaledDataset
+        dataset = UpscaledDataset(timestamps, sensors, config.upscale, config.step, config.noise, config.seed, SENSOR_ID_PREFIX)
+        print(f'Upscaled to {len(dataset.sensors)} sensors and {dataset.step_count} steps of {config.step}s ({dataset.sample_count} samples)')
+
+    fleet = dataset.sensors if dataset is not None else sensors
     if config.batches is not None:
-        config.count= config.batches * len(sensors)
-        print(f'Sending {config.batches} batches to {len(sensors)} sensors')
+        config.count= config.batches * len(fleet)
+        print(f'Sending {config.batches} batches to {len(fleet)} sensors')
 
-    ic.connect_to_iot_core(BROKER, PORT, ROOT_CERT_FILE, CERT_FILE, KEY_FILE, CLIENT_ID)
+    first_timestamp = datetime.fromisoformat(timestamps[0])
+    sample_rate, rates_per_type = SAMPLE_RATE_PER_SENSOR, SAMPLE_RATES_PER_SENSOR_TYPE
+    if config.legacy_pacing:
+        # One sample per sensor and row, with the row interval passing in one sample interval of real time
+        row_interval = (datetime.fromisoformat(timestamps[1]) - first_timestamp).total_seconds() if len(timestamps) > 1 else 3600
+        sample_rate, rates_per_type = 1 / row_interval, {}
+        config.speed *= row_interval * SAMPLE_RATE_PER_SENSOR
+
+    scheduler = SensorScheduler(
+        sensors,
+        sample_rate,
+        rates_per_type,
+        jitter=config.jitter,
+        pattern=ArrivalPattern(config.pattern),
+        start_time_of_day=first_timestamp.hour * 3600 + first_timestamp.minute * 60 + first_timestamp.second,
+    )
 
-    message_count, runtime = send_loop(timestamps, sensors, config.count, config.silent)
+    sink.open()
 
-    ic.disconnect_from_iot_core()
+    deadband = Deadband(config.deadband, config.heartbeat) if config.deadband is not None else None
+
+    if dataset is not None:
+        message_count, runtime = upscaled_send_loop(
+            dataset, config.count, config.silent, sink, config.frame_size,
+            config.virtual_clock, config.speed, deadband
+        )
+    else:
+        message_count, runtime = send_loop(
+            timestamps, sensors, config.count, config.silent, sink, config.frame_size,
+            scheduler, config.virtual_clock, config.speed, deadband
+        )
+
+    sink.close()
 
     print(
-        f"Sent {message_count} messages in {round(runtime, 2)}s ({round(60* message_count/runtime)} msg/min)"
+        f"Sent {message_count} messages in {round(runtime, 2)}s ({round(60* message_count/runtime)} msg/min) to the {config.sink} sink: {sink.summary()}"
     )
 
+    if deadband is not None:
+        print(deadband.summary())
+
 
 if __name__ == "__main__":
     main()
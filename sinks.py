@@ -0,0 +1,187 @@
+import abc
+import base64
+import json
+import os
+import struct
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The payload codec is shared with the ingest Lambda
+sys.path.append(os.path.join(ROOT_DIR, 'lambda', 'common'))
+from payload_codec import detect_encoding, encode_readings
+
+SINKS = ['mqtt', 'file', 'lambda', 'null']
+
+RECORD_HEADER = struct.Struct('>I')  # Length prefix of the payloads in binary recordings
+
+
+class Sink(abc.ABC):
+    """
+    Destination of the messages sent by the simulator. A message carries one or more readings.
+    """
+
+    def __init__(self, encoding= 'json'):
+        self.encoding = encoding
+        self.message_count = 0
+        self.byte_count = 0
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def send_readings(self, readings):
+        self.send_payload(encode_readings(readings, self.encoding))
+
+    def send_payload(self, payload):
+        """Sends one already encoded message."""
+        self.message_count += 1
+        self.byte_count += len(payload)
+        self.write(payload)
+
+    @abc.abstractmethod
+    def write(self, payload):
+        """Delivers one encoded message to the destination."""
+
+    def summary(self):
+        return f"{self.message_count} messages, {self.byte_count} bytes"
+
+
+class MqttSink(Sink):
+    """
+    Publishes the messages to AWS IoT Core, or to a local broker without TLS, e.g. for benchmarks
+    of the ingest service.
+    """
+
+    def __init__(self, encoding, topic, broker, port, root_cert_file, cert_file, key_file, client_id, local= False):
+        super().__init__(encoding)
+        self.topic = topic
+        self.connection_args = (broker, port, root_cert_file, cert_file, key_file, client_id)
+        self.local = local
+        self.iot_core = None
+
+    def open(self):
+        # Only needed for this sink, the others run without the AWS IoT SDK
+        import iot_core
+        self.iot_core = iot_core
+
+        broker, port, root_cert_file, cert_file, key_file, client_id = self.connection_args
+        if self.local:
+            self.iot_core.connect_to_local_broker(broker, port, client_id)
+        else:
+            self.iot_core.connect_to_iot_core(broker, port, root_cert_file, cert_file, key_file, client_id)
+
+    def close(self):
+        self.iot_core.disconnect_from_iot_core()
+
+    def write(self, payload):
+        self.iot_core.publish_payload_to_iot_core(self.topic, payload)
+
+
+class FileSink(Sink):
+    """
+    Records the messages to a file, which can be replayed later. JSON messages are written as
+    newline-delimited JSON, binary messages with a 4 byte length prefix. Messages of another
+    encoding are refused, as they would corrupt the recording.
+    """
+
+    def __init__(self, encoding, path):
+        super().__init__(encoding)
+        self.path = path
+        self.file = None
+
+    def open(self):
+        self.file = open(self.path, 'wb')
+
+    def close(self):
+        self.file.close()
+
+    def write(self, payload):
+        if detect_encoding(payload) != self.encoding:
+            raise ValueError(f"Cannot record a {detect_encoding(payload)} message in a {self.encoding} recording")
+
+        if self.encoding == 'json':
+            self.file.write(payload + b'\n')
+        else:
+            self.file.write(RECORD_HEADER.pack(len(payload)) + payload)
+
+
+class LambdaSink(Sink):
+    """
+    Calls the handler of the ingest Lambda in-process with the event the IoT rule would send.
+    The handler writes to the DynamoDB table of the current AWS configuration.
+    """
+
+    def __init__(self, encoding):
+        super().__init__(encoding)
+        self.handler = None
+        self.failed_count = 0
+
+    def open(self):
+        sys.path.append(os.path.join(ROOT_DIR, 'lambda', 'ingest'))
+        from lambda_function import lambda_handler
+        self.handler = lambda_handler
+
+    def write(self, payload):
+        # The JSON rule passes the parsed message, the binary rule the base64 encoded payload
+        if payload[:1] == b'{':
+            event = json.loads(payload)
+        else:
+            event = {'payload': base64.b64encode(payload).decode()}
+        event['received_time'] = int(1000 * time.time())
+
+        try:
+            response = self.handler(event, None)
+        except Exception as e:
+            # Readings the handler could neither write nor spill
+            print(f"Ingest handler failed: {e}")
+            response = {}
+        if response.get('statusCode') != 200:
+            self.failed_count += 1
+
+    def summary(self):
+        return f"{super().summary()}, {self.failed_count} failed"
+
+
+class NullSink(Sink):
+    """
+    Drops the readings without encoding them, to measure the cost of generating them.
+    """
+
+    def send_readings(self, readings):
+        self.message_count += 1
+
+    def write(self, payload):
+        pass
+
+
+def recording_encoding(path):
+    """
+    Returns the encoding of the messages of a recording, taken from its first message.
+    """
+    for payload in read_recording(path):
+        return detect_encoding(payload)
+    return 'json'
+
+
+def read_recording(path):
+    """
+    Yields the payloads of a recording written by the file sink.
+    """
+    with open(path, 'rb') as file:
+        # Binary records start with a length prefix, which never starts with '{' for payloads below 2 GB
+        if file.peek(1)[:1] == b'{':
+            for line in file:
+                if line.strip():
+                    yield line.rstrip(b'\n')
+            return
+
+        while True:
+            header = file.read(RECORD_HEADER.size)
+            if not header:
+                return
+            (length,) = RECORD_HEADER.unpack(header)
+            yield file.read(length)
@@ -0,0 +1,48 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+from lambda_loader import load_lambda
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-north-1')
+
+telegram = load_lambda('telegram_communication')
+
+
+class PackLinesTest(unittest.TestCase):
+
+    def assert_chunks_fit(self, chunks, limit=telegram.TELEGRAM_MESSAGE_LIMIT):
+        for chunk in chunks:
+            self.assertLessEqual(telegram.telegram_length(chunk), limit)
+
+    def test_short_lines_share_a_chunk(self):
+        self.assertEqual(telegram.pack_lines("a\nb\n\nc"), ["a\nb\n\nc"])
+
+    def test_lines_are_not_split(self):
+        chunks = telegram.pack_lines("a" * 3000 + "\n" + "b" * 3000)
+        self.assertEqual(chunks, ["a" * 3000, "b" * 3000])
+
+    def test_following_lines_join_the_last_piece_of_a_long_line(self):
+        message = "a" * 10000 + "\n\nb\n" + "😀" * 3000
+        chunks = telegram.pack_lines(message)
+
+        self.assertEqual([telegram.telegram_length(chunk) for chunk in chunks], [4096, 4096, 1811, 4096, 1904])
+        self.assertEqual(chunks[2], "a" * 1808 + "\n\nb")
+        self.assertEqual(chunks[3] + chunks[4], "😀" * 3000)
+        self.assert_chunks_fit(chunks)
+
+
+class DocumentCaptionTest(unittest.TestCase):
+
+    def test_single_line(self):
+        self.assertTrue(telegram.document_caption("a").endswith("(1 line in total, see the attached file)"))
+
+    def test_line_count(self):
+        caption = telegram.document_caption("a\n\nb\nc")
+        self.assertTrue(caption.endswith("(3 lines in total, see the attached file)"))
+        self.assertLessEqual(telegram.telegram_length(caption), telegram.TELEGRAM_CAPTION_LIMIT)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import math
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from sensor import Sensor
+
+# Standard deviation of the noise added to the interpolated values
+DEFAULT_NOISE = {
+    'humidity': 0.5,    # %
+    'temperature': 0.1  # °C
+}
+NOISE_CORRELATION_SECONDS = 600  # The noise of a sensor drifts slowly instead of jumping between samples
+
+
+class VirtualSensor(Sensor):
+    """
+    Sensor placed between the grid points of the data file. Its values are interpolated, so it has no data of its own.
+    """
+
+    def __init__(self, sensor_id, longitude, latitude):
+        self.longitude = longitude
+        self.latitude = latitude
+        self.humidity_data = []
+        self.temperature_data = []
+
+        self.sensor_id = sensor_id
+        self.sensor_type = self.select_random_sensor_type()
+        self.last_published = None
+
+
+def grid_shape(latitudes):
+    """
+    Returns the number of columns and rows of the grid the sensors were read from. The data file
+    lists the grid column by column, with the latitude increasing within a column.
+    """
+    resets = np.flatnonzero(np.diff(latitudes) < 0)
+    rows = resets[0] + 1 if len(resets) else len(latitudes)
+    if rows < 2 or len(latitudes) % rows or len(latitudes) // rows < 2:
+        raise ValueError('The sensors do not form a regular grid')
+    return len(latitudes) // rows, rows
+
+
+class UpscaledDataset:
+    """
+    Densifies the sensor data in space and time. Adds virtual sensors at random positions within
+    the grid cells, with values interpolated bilinearly from the four corners, and interpolates
+    the hourly rows to samples every step_seconds with correlated noise on top.
+    Samples are computed for all sensors at once, one time step at a time, so the memory use does
+    not depend on the number of samples.
+    """
+
+    def __init__(self, timestamps, sensors, scale= 1, step_seconds= 60, noise= None, seed= None, id_prefix= ''):
+        self.timestamps = timestamps
+        self.step_seconds = step_seconds
+        self.noise = DEFAULT_NOISE if noise is None else noise
+        self.rng = np.random.default_rng(seed)
+
+        self.first_timestamp = datetime.fromisoformat(timestamps[0])
+        self.row_interval = (datetime.fromisoformat(timestamps[1]) - self.first_timestamp).total_seconds() if len(timestamps) > 1 else 3600
+
+        self.humidity = np.array([sensor.humidity_data for sensor in sensors], dtype=np.float64)
+        self.temperature = np.array([sensor.temperature_data for sensor in sensors], dtype=np.float64)
+        longitudes = np.array([sensor.longitude for sensor in sensors])
+        latitudes = np.array([sensor.latitude for sensor in sensors])
+
+        # Corners and bilinear weights of every virtual sensor
+        virtual_count = max(int(round(len(sensors) * (scale - 1))), 0)
+        self.corners, self.weights = self.place_virtual_sensors(latitudes, virtual_count)
+
+        virtual_longitudes = (longitudes[self.corners] * self.weights).sum(axis=1)
+        virtual_latitudes = (latitudes[self.corners] * self.weights).sum(axis=1)
+        self.sensors = sensors + [
+            VirtualSensor(f'{id_prefix}sensor_v{index}', longitude, latitude)
+            for index, (longitude, latitude) in enumerate(zip(virtual_longitudes.tolist(), virtual_latitudes.tolist()))
+        ]
+
+    def place_virtual_sensors(self, latitudes, count):
+        if count == 0:
+            return np.zeros((0, 4), dtype=np.int64), np.zeros((0, 4))
+
+        columns, rows = grid_shape(latitudes)
+        cells = self.rng.integers(0, (columns - 1) * (rows - 1), count)
+        column, row = cells // (rows - 1), cells % (rows - 1)
+
+        lower_left = column * rows + row
+        corners = np.stack([lower_left, lower_left + 1, lower_left + rows, lower_left + rows + 1], axis=1)
+
+        u, v = self.rng.random(count), self.rng.random(count)
+        weights = np.stack([(1 - u) * (1 - v), (1 - u) * v, u * (1 - v), u * v], axis=1)
+        return corners, weights
+
+    @property
+    def step_count(self):
+        """Number of time steps, from the first to the last row of the data file."""
+        return int(self.row_interval * (len(self.timestamps) - 1) // self.step_seconds) + 1
+
+    @property
+    def sample_count(self):
+        return self.step_count * len(self.sensors)
+
+    def row_values(self, data, row):
+        """Values of all sensors, including the virtual ones, at a row of the data file."""
+        base = data[:, row]
+        return np.concatenate([base, (base[self.corners] * self.weights).sum(axis=1)])
+
+    def steps(self):
+        """
+        Yields the seconds since the first row, the ISO timestamp and the humidity and temperature
+        arrays of all sensors for every time step.
+        """
+        sensor_count = len(self.sensors)
+        correlation = math.exp(-self.step_seconds / NOISE_CORRELATION_SECONDS)
+        innovation = math.sqrt(1 - correlation ** 2)
+        noise_state = {
+            parameter: self.rng.normal(0, sigma, sensor_count)
+            for parameter, sigma in self.noise.items() if sigma > 0
+        }
+
+        last_row = len(self.timestamps) - 1
+        cached_row = None
+        for step in range(self.step_count):
+            seconds = step * self.step_seconds
+            position = seconds / self.row_interval
+            row = min(int(position), max(last_row - 1, 0))
+            fraction = min(position - row, 1.0) if last_row > 0 else 0.0
+
+            # Neighbouring rows stay the same for all steps in between
+            if row != cached_row:
+                next_row = min(row + 1, last_row)
+                humidity_rows = self.row_values(self.humidity, row), self.row_values(self.humidity, next_row)
+                temperature_rows = self.row_values(self.temperature, row), self.row_values(self.temperature, next_row)
+                cached_row = row
+
+            humidity = humidity_rows[0] + fraction * (humidity_rows[1] - humidity_rows[0])
+            temperature = temperature_rows[0] + fraction * (temperature_rows[1] - temperature_rows[0])
+
+            # AR(1) noise: every sensor drifts around the interpolated value
+            for parameter, state in noise_state.items():
+                state *= correlation
+                state += self.rng.normal(0, innovation * self.noise[parameter], sensor_count)
+            if 'humidity' in noise_state:
+                humidity = np.clip(humidity + noise_state['humidity'], 0, 100)
+            if 'temperature' in noise_state:
+                temperature = temperature + noise_state['temperature']
+
+            timestamp = (self.first_timestamp + timedelta(seconds=seconds)).isoformat()
+            yield seconds, timestamp, humidity, temperature
+
+    def samples(self):
+        """
+        Yields one (seconds, timestamp, sensor, values) tuple per sensor and time step.
+        """
+        for seconds, timestamp, humidity, temperature in self.steps():
+            for sensor, sensor_humidity, sensor_temperature in zip(self.sensors, humidity.tolist(), temperature.tolist()):
+                yield seconds, timestamp, sensor, {'humidity': sensor_humidity, 'temperature': sensor_temperature}